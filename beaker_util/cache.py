@@ -0,0 +1,94 @@
+import base64
+import json
+import os
+import tempfile
+import time
+from typing import Callable, TypeVar
+from urllib.parse import quote
+
+from google.protobuf.message import DecodeError, Message
+
+from beaker_util.config import CONF_DIR
+
+
+CACHE_DIR = os.path.join(CONF_DIR, "cache")
+CACHE_FORMAT_VERSION = 1
+
+# How long (in seconds) each type of cached entity is considered fresh
+CACHE_TTLS = {
+    "clusters": 24 * 60 * 60,
+    "cluster_nodes": 6 * 60 * 60,
+    "node": 7 * 24 * 60 * 60,
+}
+
+M = TypeVar("M", bound=Message)
+
+
+class MetadataCache:
+    """
+    On-disk TTL cache for slowly-changing Beaker metadata (clusters and nodes).
+    Each entry is a single JSON file of serialized protobufs, replaced atomically so concurrent processes never see partial writes.
+    """
+
+    def __init__(self, read: bool = True, write: bool = True, cache_dir: str = CACHE_DIR):
+        self.read = read
+        self.write = write
+        self.cache_dir = cache_dir
+
+    @classmethod
+    def from_args(cls, args):
+        if getattr(args, "no_cache", False):
+            return cls(read=False, write=False)
+        return cls(read=not getattr(args, "refresh", False), write=True)
+
+    def _path(self, entity: str, key: str):
+        return os.path.join(self.cache_dir, entity, quote(key, safe="") + ".json")
+
+    def _load(self, entity: str, key: str, message_type: type[M]) -> list[M] | None:
+        try:
+            with open(self._path(entity, key), "r") as f:
+                entry = json.load(f)
+            if entry["version"] != CACHE_FORMAT_VERSION or time.time() - entry["created"] > CACHE_TTLS[entity]:
+                return None
+            return [message_type.FromString(base64.b64decode(item)) for item in entry["items"]]
+        except (OSError, ValueError, KeyError, TypeError, DecodeError):
+            # missing, corrupt, or from an incompatible version; treat as a miss
+            return None
+
+    def _store(self, entity: str, key: str, messages: list[Message]):
+        path = self._path(entity, key)
+        entry = {
+            "version": CACHE_FORMAT_VERSION,
+            "created": time.time(),
+            "items": [base64.b64encode(m.SerializeToString()).decode("ascii") for m in messages],
+        }
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entry, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            # caching is best-effort, a read-only or full disk shouldn't break the command
+            pass
+
+    def get_list(self, entity: str, key: str, message_type: type[M], loader: Callable[[], list[M]]) -> list[M]:
+        if self.read:
+            messages = self._load(entity, key, message_type)
+            if messages is not None:
+                return messages
+        messages = list(loader())
+        if self.write:
+            self._store(entity, key, messages)
+        return messages
+
+    def get(self, entity: str, key: str, message_type: type[M], loader: Callable[[], M]) -> M:
+        return self.get_list(entity, key, message_type, lambda: [loader()])[0]
+
+
+# Cache that always goes to the API, for callers that don't have a configured cache
+NO_CACHE = MetadataCache(read=False, write=False)
@@ -0,0 +1,78 @@
+from contextlib import closing
+import re
+import time
+
+from beaker import Beaker
+from tabulate import tabulate
+
+from beaker_util.cache import MetadataCache
+from beaker_util.daemon import get_daemon_clusters, use_daemon
+from beaker_util.history import open_history, record_samples
+from beaker_util.live import LiveBlock
+from beaker_util.utils import inject_beaker, iter_cluster_usage, list_clusters, print_ndjson, summarize_cluster_usage
+
+
+CLUSTER_SORT_KEYS = {
+    "name": lambda info: info["name"],
+    "total_gpus": lambda info: -info["gpus"],
+    "free_gpus": lambda info: info["used_gpus"] - info["gpus"],
+}
+
+
+def format_clusters(cluster_infos: list[dict], sort: str, print_node_availability: bool) -> str:
+    # the cluster list may come from the cache, so sort on the freshly computed usage instead of server-side
+    cluster_infos = sorted(cluster_infos, key=CLUSTER_SORT_KEYS[sort])
+    rows = []
+    for cluster_info in cluster_infos:
+        row = []
+        row.append(cluster_info['name'])
+        row.append(cluster_info['used_gpus'])
+        row.append(cluster_info['gpus'])
+        if print_node_availability and cluster_info['gpus'] > 0:
+            node_free_gpus = cluster_info['node_gpu_availability']
+            availability_str = "{" + ", ".join(f"{i}: {node_free_gpus.get(i, 0)}" for i in range(max(node_free_gpus.keys()) + 1)) + "}"
+            row.append(availability_str)
+        rows.append(row)
+
+    headers = ["Cluster", "Used GPUs", "Total GPUs"]
+    if print_node_availability:
+        headers.append("Node Availability")
+    return tabulate(rows, headers=headers)
+
+
+@inject_beaker
+def clusters(beaker: Beaker, args, _):
+    # samples are stamped with the current time, so they can't come from the daemon's or the cache's older snapshots
+    if not args.sample and use_daemon(args) and (daemon_clusters := get_daemon_clusters()) is not None:
+        cluster_usage = [(c, nodes, jobs) for c, nodes, jobs in daemon_clusters if not args.filter or re.match(args.filter, c.name)]
+        n_selected = len(cluster_usage)
+    else:
+        cache = MetadataCache.from_args(args)
+        selected_clusters = [c for c in list_clusters(beaker, cache) if not args.filter or re.match(args.filter, c.name)]
+        node_cache = MetadataCache(read=False, write=cache.write) if args.sample else cache
+        cluster_usage = iter_cluster_usage(beaker, selected_clusters, args.n_workers, node_cache)
+        n_selected = len(selected_clusters)
+
+    if args.sample:
+        # taken when sampling starts, so that all clusters of one run share a timestamp
+        sample_time = time.time()
+        with closing(open_history(args.history_db)) as conn:
+            n_clusters, n_nodes = record_samples(conn, cluster_usage, sample_time)
+        print(f"Recorded {n_clusters} cluster(s) with {n_nodes} GPU node(s) to {args.history_db}")
+        return
+
+    # on a terminal, show clusters as they resolve (re-sorted every time)
+    live = LiveBlock()
+    cluster_infos = []
+    for n_done, (cluster, nodes, jobs) in enumerate(cluster_usage, 1):
+        cluster_info = summarize_cluster_usage(cluster, nodes, jobs)
+        if not args.all and cluster_info['gpus'] == 0:
+            continue
+        if args.format == "ndjson":
+            print_ndjson(cluster_info)
+            continue
+        cluster_infos.append(cluster_info)
+        live.update(lambda: format_clusters(cluster_infos, args.sort, args.print_node_availability).splitlines()
+                    + [f"Fetching clusters... ({n_done} of {n_selected})"])
+    if args.format != "ndjson":
+        live.finish(format_clusters(cluster_infos, args.sort, args.print_node_availability).splitlines())
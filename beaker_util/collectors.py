@@ -0,0 +1,347 @@
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, replace
+import json
+import threading
+import time
+
+import fabric
+
+
+SMI_FIELDS = ("uuid", "name", "memory.used", "memory.total", "utilization.gpu")
+# Column names as printed in the nvidia-smi csv header
+SMI_COLUMNS = ("uuid", "name", "memory.used [MiB]", "memory.total [MiB]", "utilization.gpu [%]")
+SMI_CMD = f"nvidia-smi --query-gpu={','.join(SMI_FIELDS)} --format=csv"
+DOCKER_STATS_CMD = "docker stats --no-stream --no-trunc --format json"
+# Separates the output of the two probes when they run in one remote command
+PROBE_DELIMITER = "--- beakerutil docker stats ---"
+# Both probes in a single exec, so that polling a host takes one round trip. If nvidia-smi fails, the command fails
+POLL_CMD = f"{SMI_CMD} && echo '{PROBE_DELIMITER}' && {DOCKER_STATS_CMD}"
+
+# Seconds allowed for establishing an SSH connection to a node
+CONNECT_TIMEOUT = 10
+# Default upper bound on the number of hosts polled, or connected to, at once
+DEFAULT_MAX_HOSTS = 64
+
+
+def parse_smi_line(line: str) -> dict[str, str] | None:
+    """
+    Parse one line of `nvidia-smi --query-gpu=... --format=csv` output, returning None for headers or malformed lines.
+    """
+    values = [v.strip() for v in line.split(",")]
+    if len(values) != len(SMI_COLUMNS) or values[0] == "uuid":
+        return None
+    return dict(zip(SMI_COLUMNS, values))
+
+
+def parse_docker_line(line: str) -> dict[str, str] | None:
+    """
+    Parse one line of `docker stats --format json` output, returning None for lines that aren't a stats record.
+    """
+    # when streaming, docker prefixes each refresh with terminal control sequences
+    start = line.find("{")
+    if start < 0:
+        return None
+    try:
+        return json.loads(line[start:])
+    except ValueError:
+        return None
+
+
+def parse_smi_output(output: str) -> dict[str, dict[str, str]]:
+    """
+    Parse the full output of `nvidia-smi --query-gpu=... --format=csv` into rows keyed by GPU uuid.
+    """
+    return {row["uuid"]: row for line in output.splitlines() if (row := parse_smi_line(line)) is not None}
+
+
+def parse_docker_output(output: str) -> dict[str, dict[str, str]]:
+    """
+    Parse the full output of `docker stats --no-stream --format json` into rows keyed by container name.
+    """
+    return {row["Name"]: row for line in output.splitlines() if (row := parse_docker_line(line)) is not None}
+
+
+def parse_poll_output(output: str) -> tuple[dict[str, dict[str, str]], dict[str, dict[str, str]]]:
+    """
+    Split the output of POLL_CMD into the parsed nvidia-smi rows and docker stats rows.
+    """
+    smi_output, delimiter, docker_output = output.partition(PROBE_DELIMITER)
+    if not delimiter:
+        raise ValueError("Missing docker stats output")
+    return parse_smi_output(smi_output), parse_docker_output(docker_output)
+
+
+def parse_stream_line(line: str) -> tuple[str, dict[str, str]] | None:
+    """
+    Parse one line of the interleaved output of the streaming probes, returning ("gpu" or "container", row).
+    """
+    # docker stats lines are JSON, nvidia-smi lines never contain braces
+    if (row := parse_docker_line(line)) is not None:
+        return "container", row
+    if (row := parse_smi_line(line)) is not None:
+        return "gpu", row
+    return None
+
+
+@dataclass
+class HostSample:
+    gpus: dict[str, dict[str, str]]  # keyed by GPU uuid
+    containers: dict[str, dict[str, str]]  # keyed by container name
+    updated: float
+    stale: bool = False
+
+
+class Backoff:
+    """
+    Exponential backoff for reconnecting to a failing host.
+    """
+
+    def __init__(self, initial: float = 1, maximum: float = 60):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0.0
+        self.retry_at = 0.0
+
+    def failure(self):
+        self.delay = min(self.maximum, self.delay * 2) if self.delay else self.initial
+        self.retry_at = time.time() + self.delay
+
+    def success(self):
+        self.delay = 0.0
+        self.retry_at = 0.0
+
+    def ready(self) -> bool:
+        return time.time() >= self.retry_at
+
+    def sleep(self, closed: threading.Event):
+        closed.wait(max(0.0, self.retry_at - time.time()))
+
+
+class SampleStore:
+    """
+    Thread-safe store of the latest GPU and container stats seen for each host.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._gpus: dict[str, dict[str, dict[str, str]]] = defaultdict(dict)
+        self._containers: dict[str, dict[str, dict[str, str]]] = defaultdict(dict)
+        self._updated: dict[str, float] = {}
+
+    def update_gpu(self, host: str, row: dict[str, str]):
+        with self._lock:
+            self._gpus[host][row["uuid"]] = row
+            self._updated[host] = time.time()
+
+    def update_container(self, host: str, row: dict[str, str]):
+        with self._lock:
+            self._containers[host][row["Name"]] = row
+            self._updated[host] = time.time()
+
+    def set(self, host: str, gpus: dict[str, dict], containers: dict[str, dict]):
+        with self._lock:
+            self._gpus[host] = gpus
+            self._containers[host] = containers
+            self._updated[host] = time.time()
+
+    def remove(self, host: str):
+        with self._lock:
+            self._gpus.pop(host, None)
+            self._containers.pop(host, None)
+            self._updated.pop(host, None)
+
+    def get(self, host: str) -> HostSample | None:
+        with self._lock:
+            if host not in self._updated:
+                return None
+            return HostSample(dict(self._gpus[host]), dict(self._containers[host]), self._updated[host])
+
+
+class StreamingCollector:
+    """
+    Keeps a long-lived `nvidia-smi -lms` and a streaming `docker stats` running per host, together in one remote
+    command over one connection, parsing their interleaved output incrementally into a SampleStore that can be read
+    without blocking. At most `max_hosts` connections are being opened at once.
+    Streams that die are restarted in the background with backoff, and hosts that stop reporting are marked stale.
+    """
+
+    def __init__(self, hosts: list[str], interval: float, stale_after: float, max_hosts: int = DEFAULT_MAX_HOSTS):
+        self.hosts = list(hosts)
+        self.interval = interval
+        self.stale_after = stale_after
+        self.store = SampleStore()
+        self._lock = threading.Lock()
+        # opening a connection is the expensive part, so don't handshake with a whole cluster at once
+        self._connect_slots = threading.BoundedSemaphore(max_hosts)
+        self._connections: dict[str, fabric.Connection] = {}
+        # set when the host's streams should stop, either because it was removed or the collector was closed
+        self._stopped: dict[str, threading.Event] = {}
+
+    def start(self):
+        with self._lock:
+            for host in self.hosts:
+                self._start_host(host)
+        return self
+
+    def _start_host(self, host: str):
+        conn = self._connections[host] = fabric.Connection(host, forward_agent=False, connect_timeout=CONNECT_TIMEOUT)
+        stopped = self._stopped[host] = threading.Event()
+        threading.Thread(target=self._stream, args=(host, conn, stopped), daemon=True).start()
+
+    def _stop_host(self, host: str):
+        self._stopped.pop(host).set()
+        self._connections.pop(host).close()
+        self.store.remove(host)
+
+    def set_hosts(self, hosts: list[str]):
+        """
+        Start streams on newly added hosts and stop them on removed ones, leaving existing streams untouched.
+        """
+        with self._lock:
+            for host in set(self.hosts) - set(hosts):
+                self._stop_host(host)
+            for host in set(hosts) - set(self.hosts):
+                self._start_host(host)
+            self.hosts = list(hosts)
+
+    def _stream(self, host: str, conn: fabric.Connection, stopped: threading.Event):
+        smi_cmd = f"nvidia-smi --query-gpu={','.join(SMI_FIELDS)} --format=csv,noheader -lms {max(int(self.interval * 1000), 100)}"
+        # nvidia-smi runs in the background of the same shell, so both are hung up on when the channel closes
+        cmd = f"{smi_cmd} & docker stats --no-trunc --format json"
+        update = {"gpu": self.store.update_gpu, "container": self.store.update_container}
+        backoff = Backoff()
+        while not stopped.is_set():
+            try:
+                with self._connect_slots:
+                    channel = conn.create_session()
+                # with a pty, the remote command is killed when the channel closes
+                channel.get_pty()
+                channel.exec_command(cmd)
+                buffer = ""
+                while not stopped.is_set():
+                    data = channel.recv(4096)
+                    if not data:
+                        break
+                    backoff.success()
+                    buffer += data.decode(errors="replace")
+                    *lines, buffer = buffer.replace("\r", "\n").split("\n")
+                    for line in lines:
+                        if (parsed := parse_stream_line(line)) is not None:
+                            update[parsed[0]](host, parsed[1])
+                channel.close()
+            except Exception:
+                # an unreachable host is retried in the background rather than taking down the monitor
+                pass
+            backoff.failure()
+            backoff.sleep(stopped)
+
+    def wait_ready(self, timeout: float):
+        """
+        Block until every host has reported at least once, or until the timeout elapses.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline and any(self.store.get(h) is None for h in self.hosts):
+            time.sleep(0.1)
+
+    def collect(self) -> dict[str, HostSample]:
+        """
+        Return the latest sample of each host without blocking. Hosts that stopped reporting are marked stale.
+        """
+        now = time.time()
+        return {
+            host: replace(sample, stale=now - sample.updated > self.stale_after)
+            for host in self.hosts
+            if (sample := self.store.get(host)) is not None
+        }
+
+    def close(self):
+        with self._lock:
+            for host in list(self._stopped.keys()):
+                self._stop_host(host)
+
+
+class PollingCollector:
+    """
+    Runs nvidia-smi and `docker stats --no-stream` on every host each round, in one command over a pooled connection
+    per host, with a deadline per round and at most `max_hosts` hosts polled at once.
+    Hosts that miss the deadline keep their last known values (marked stale) and are picked up once they finish,
+    and hosts that fail are reconnected in the background with backoff, so one bad node never stalls or kills the monitor.
+    """
+
+    def __init__(self, hosts: list[str], timeout: float, max_hosts: int = DEFAULT_MAX_HOSTS):
+        self.hosts = list(hosts)
+        self.timeout = timeout
+        self.store = SampleStore()
+        self._executor = ThreadPoolExecutor(max_workers=max_hosts)
+        self._connections: dict[str, fabric.Connection] = {}
+        self._in_flight: dict[str, Future] = {}
+        self._backoffs = {host: Backoff() for host in self.hosts}
+        # guards the host list against concurrent set_hosts calls
+        self._lock = threading.Lock()
+
+    def _connection(self, host: str) -> fabric.Connection:
+        if host not in self._connections:
+            self._connections[host] = fabric.Connection(host, forward_agent=False, connect_timeout=CONNECT_TIMEOUT)
+        return self._connections[host]
+
+    def _poll_host(self, host: str):
+        conn = self._connection(host)
+        # a command hung well past the deadline is abandoned so the host can be retried
+        result = conn.run(POLL_CMD, hide=True, timeout=self.timeout * 10)
+        self.store.set(host, *parse_poll_output(result.stdout))
+
+    def _harvest(self):
+        for host, future in list(self._in_flight.items()):
+            if not future.done():
+                continue
+            del self._in_flight[host]
+            if host not in self._backoffs:
+                # removed while in flight
+                continue
+            if future.exception() is None:
+                self._backoffs[host].success()
+            else:
+                self._backoffs[host].failure()
+                # drop the connection so the next attempt reconnects from scratch
+                if (conn := self._connections.pop(host, None)) is not None:
+                    conn.close()
+
+    def set_hosts(self, hosts: list[str]):
+        """
+        Start polling newly added hosts and forget removed ones, reusing the connections of hosts that remain.
+        """
+        with self._lock:
+            for host in set(self.hosts) - set(hosts):
+                self._backoffs.pop(host, None)
+                self.store.remove(host)
+                if (conn := self._connections.pop(host, None)) is not None:
+                    conn.close()
+            for host in hosts:
+                self._backoffs.setdefault(host, Backoff())
+            self.hosts = list(hosts)
+
+    def collect(self) -> dict[str, HostSample]:
+        """
+        Run one collection round, returning within the deadline. Hosts that didn't report this round are marked stale.
+        """
+        round_start = time.time()
+        with self._lock:
+            self._harvest()
+            for host in self.hosts:
+                if host not in self._in_flight and self._backoffs[host].ready():
+                    self._in_flight[host] = self._executor.submit(self._poll_host, host)
+            in_flight = list(self._in_flight.values())
+        wait(in_flight, timeout=self.timeout)
+        with self._lock:
+            self._harvest()
+            return {
+                host: replace(sample, stale=sample.updated < round_start)
+                for host in self.hosts
+                if (sample := self.store.get(host)) is not None
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for conn in self._connections.values():
+            conn.close()
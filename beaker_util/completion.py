@@ -0,0 +1,228 @@
+import json
+import os
+import sys
+import tempfile
+import time
+
+from beaker_util.config import CONF_DIR, DEFAULT_LAUNCH_CONFIG, LAUNCH_CONF_PATH
+
+# Completion runs on every <TAB>, so this module must stay cheap to import: no beaker, no network, yaml only when
+# launch.conf changed since it was last read.
+
+COMPLETION_CACHE_DIR = os.path.join(CONF_DIR, "completion")
+SESSIONS_CACHE_PATH = os.path.join(COMPLETION_CACHE_DIR, "sessions.json")
+LAUNCH_CONFIGS_CACHE_PATH = os.path.join(COMPLETION_CACHE_DIR, "launch_configs.json")
+COMPLETION_CACHE_VERSION = 1
+
+# Arguments (by subcommand and dest) whose values are completed from the cache, and the kind of value they take
+DYNAMIC_ARGS = {
+    ("launch", "launch_config"): "launch-configs",
+    ("attach", "session_idx"): "attach-indices",
+    ("attach", "name"): "attach-names",
+    ("attach", "id"): "attach-ids",
+    ("stop", "session_idx"): "indices",
+    ("stop", "name"): "names",
+    ("stop", "id"): "ids",
+    ("stop", "match"): "names",
+}
+
+
+def _write_json(path: str, data: dict):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        # completion is a convenience, it shouldn't break the command that refreshes it
+        pass
+
+
+def _read_json(path: str) -> dict | None:
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+        return data if data.get("version") == COMPLETION_CACHE_VERSION else None
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def save_sessions(sessions: list[dict]):
+    """
+    Remember the sessions last shown or resolved, in `list` order. Each has an id, name, interactive, hostname and status.
+    """
+    _write_json(SESSIONS_CACHE_PATH, {"version": COMPLETION_CACHE_VERSION, "updated": time.time(), "sessions": sessions})
+
+
+def load_launch_configs() -> list[str]:
+    try:
+        mtime = os.stat(LAUNCH_CONF_PATH).st_mtime
+    except OSError:
+        return []
+    cached = _read_json(LAUNCH_CONFIGS_CACHE_PATH)
+    if cached is not None and cached["mtime"] == mtime:
+        return cached["names"]
+    import yaml
+
+    try:
+        with open(LAUNCH_CONF_PATH, "r") as f:
+            conf = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError):
+        return []
+    names = sorted(k for k in (conf or {}) if k != DEFAULT_LAUNCH_CONFIG)
+    _write_json(LAUNCH_CONFIGS_CACHE_PATH, {"version": COMPLETION_CACHE_VERSION, "mtime": mtime, "names": names})
+    return names
+
+
+def candidates(kind: str) -> list[tuple[str, str]]:
+    """
+    The completions of the given kind, each with a short description.
+    """
+    if kind == "launch-configs":
+        return [(name, "launch configuration") for name in load_launch_configs()]
+
+    cached = _read_json(SESSIONS_CACHE_PATH)
+    sessions = cached["sessions"] if cached is not None else []
+    if kind.startswith("attach-"):
+        # attach only counts interactive sessions, which come first in `list`, so their indices are the same
+        sessions = [s for s in sessions if s["interactive"]]
+        kind = kind[len("attach-"):]
+
+    def describe(s: dict, label: str) -> str:
+        where = f"on {s['hostname']}" if s["hostname"] else "waiting for assignment"
+        return f"{label} {where}, {s['status']}"
+
+    if kind == "indices":
+        return [(str(i), describe(s, s["name"] or s["id"])) for i, s in enumerate(sessions)]
+    elif kind == "names":
+        return [(s["name"], describe(s, s["id"])) for s in sessions if s["name"]]
+    elif kind == "ids":
+        return [(s["id"], describe(s, s["name"] or "session")) for s in sessions]
+    return []
+
+
+def complete(kind: str):
+    """
+    Entry point of the hidden `beakerutil __complete KIND` command used by the shell scripts.
+    """
+    for value, description in candidates(kind):
+        sys.stdout.write(f"{value}\t{description}\n")
+
+
+def completion_spec() -> dict[str, dict]:
+    """
+    The options of each subcommand, the choices or cached values of its positional argument,
+    and which of its options take cached values, taken from the argument parser.
+    """
+    from argparse import _SubParsersAction
+    from beaker_util.main import make_parser
+
+    parser = make_parser()
+    subparsers = next(a for a in parser._actions if isinstance(a, _SubParsersAction))
+    spec = {"": {"options": [o for a in parser._actions for o in a.option_strings], "positional": list(subparsers.choices)}}
+    for command, subparser in subparsers.choices.items():
+        options, option_values, positional = [], {}, []
+        for action in subparser._actions:
+            if isinstance(action, _SubParsersAction):
+                positional = list(action.choices)
+            elif action.option_strings:
+                options += action.option_strings
+                if (command, action.dest) in DYNAMIC_ARGS:
+                    option_values.update({o: DYNAMIC_ARGS[command, action.dest] for o in action.option_strings})
+            elif (command, action.dest) in DYNAMIC_ARGS:
+                positional = DYNAMIC_ARGS[command, action.dest]
+            elif action.choices is not None:
+                positional = list(action.choices)
+        spec[command] = {"options": options, "option_values": option_values, "positional": positional}
+    return spec
+
+
+def _bash_words(positional: list[str] | str) -> str:
+    if isinstance(positional, str):
+        return f'$(beakerutil __complete {positional} 2>/dev/null | cut -f1)'
+    return " ".join(positional)
+
+
+def bash_script(spec: dict[str, dict]) -> str:
+    commands = [c for c in spec if c]
+    value_cases = "".join(
+        f"            {'|'.join(f'{command}:{o}' for o, k in spec[command]['option_values'].items() if k == kind)}) "
+        f"matched=1; words=\"{_bash_words(kind)}\" ;;\n"
+        for command in commands for kind in dict.fromkeys(spec[command]["option_values"].values())
+    )
+    option_cases = "".join(f"                {command}) words=\"{' '.join(spec[command]['options'])}\" ;;\n" for command in commands)
+    positional_cases = "".join(
+        f"                {command}) words=\"{_bash_words(spec[command]['positional'])}\" ;;\n"
+        for command in commands if spec[command]["positional"]
+    )
+    return f"""_beakerutil_complete() {{
+    local cur="${{COMP_WORDS[COMP_CWORD]}}" prev="${{COMP_WORDS[COMP_CWORD-1]}}" cmd="" words="" matched="" w
+    [[ "${{COMP_WORDS[0]##*/}}" == beakerlaunch ]] && cmd=launch
+    if [[ -z "$cmd" ]]; then
+        for w in "${{COMP_WORDS[@]:1:COMP_CWORD-1}}"; do
+            case "$w" in {"|".join(commands)}) cmd="$w"; break ;; esac
+        done
+    fi
+    if [[ -z "$cmd" ]]; then
+        words="{" ".join(spec[""]["positional"] + spec[""]["options"])}"
+    else
+        case "$cmd:$prev" in
+{value_cases}        esac
+        if [[ -z "$matched" && "$cur" == -* ]]; then
+            case "$cmd" in
+{option_cases}            esac
+        elif [[ -z "$matched" ]]; then
+            case "$cmd" in
+{positional_cases}            esac
+        fi
+    fi
+    COMPREPLY=($(compgen -W "$words" -- "$cur"))
+}}
+complete -o default -F _beakerutil_complete beakerutil beakerlaunch
+"""
+
+
+def zsh_script(spec: dict[str, dict]) -> str:
+    return "autoload -U +X bashcompinit && bashcompinit\n" + bash_script(spec)
+
+
+def _fish_values(positional: list[str] | str) -> str:
+    if isinstance(positional, str):
+        return f"'(beakerutil __complete {positional} 2>/dev/null)'"
+    return "'" + " ".join(positional) + "'"
+
+
+def _fish_option(option: str) -> str:
+    return f"-l {option[2:]}" if option.startswith("--") else f"-s {option[1:]}"
+
+
+def fish_script(spec: dict[str, dict]) -> str:
+    commands = [c for c in spec if c]
+    lines = [
+        "complete -c beakerutil -f",
+        "complete -c beakerlaunch -f",
+        f"complete -c beakerutil -n __fish_use_subcommand -a {_fish_values(commands)}",
+    ] + [f"complete -c beakerutil -n __fish_use_subcommand {_fish_option(o)}" for o in spec[""]["options"] if o not in ("-h", "--help")]
+    for command in commands:
+        for program, condition in [("beakerutil", f"-n '__fish_seen_subcommand_from {command}'"), ("beakerlaunch", "")]:
+            if program == "beakerlaunch" and command != "launch":
+                continue
+            s = spec[command]
+            if s["positional"]:
+                lines.append(f"complete -c {program} {condition} -f -a {_fish_values(s['positional'])}".replace("  ", " "))
+            for option in s["options"]:
+                values = f" -r -a {_fish_values(s['option_values'][option])}" if option in s["option_values"] else ""
+                lines.append(f"complete -c {program} {condition} {_fish_option(option)}{values}".replace("  ", " "))
+    return "\n".join(lines) + "\n"
+
+
+SCRIPTS = {"bash": bash_script, "zsh": zsh_script, "fish": fish_script}
+
+
+def completion(args, _):
+    print(SCRIPTS[args.shell](completion_spec()), end="")
@@ -0,0 +1,8 @@
+import os
+
+
+CONF_DIR = os.path.join(os.environ["HOME"], ".beakerutil")
+LAUNCH_CONF_PATH = os.path.abspath(os.path.join(CONF_DIR, "launch.conf"))
+DEFAULT_LAUNCH_CONFIG = "DEFAULT"
+DAEMON_SOCKET_PATH = os.path.join(CONF_DIR, "daemon.sock")
+CLUSTER_HISTORY_PATH = os.path.join(CONF_DIR, "cluster_history.db")
@@ -0,0 +1,237 @@
+import base64
+import json
+import os
+import socket
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+import sys
+import threading
+import time
+from typing import TypeVar
+
+from beaker import Beaker, BeakerCluster, BeakerJob, BeakerNode, BeakerWorkload
+from google.protobuf.message import DecodeError, Message
+
+from beaker_util.cache import MetadataCache
+from beaker_util.config import CONF_DIR, DAEMON_SOCKET_PATH
+from beaker_util.utils import DEFAULT_N_WORKERS, inject_beaker, iter_cluster_usage, iter_sessions, list_clusters
+
+# Seconds between refreshes of the sessions and clusters held by the daemon
+DEFAULT_REFRESH_INTERVAL = 30
+# Seconds a command waits for the daemon before falling back to the API
+CLIENT_TIMEOUT = 2
+# Snapshots that haven't been refreshed for this many intervals (e.g. the daemon lost its connection) aren't used
+MAX_AGE_INTERVALS = 3
+
+M = TypeVar("M", bound=Message)
+
+
+def _encode(message: Message | None) -> str | None:
+    return base64.b64encode(message.SerializeToString()).decode("ascii") if message is not None else None
+
+
+def _decode(message_type: type[M], data: str | None) -> M | None:
+    return message_type.FromString(base64.b64decode(data)) if data is not None else None
+
+
+class DaemonState:
+    """
+    Sessions and cluster usage, re-fetched in the background every `interval` seconds. Each is stored ready to send,
+    and replaced wholesale, so that requests are answered without touching the API or waiting on a refresh.
+    """
+
+    def __init__(self, beaker: Beaker, interval: float, n_workers: int = DEFAULT_N_WORKERS):
+        self.beaker = beaker
+        self.interval = interval
+        self.n_workers = n_workers
+        self.sessions: dict | None = None
+        self.clusters: dict | None = None
+        # ids of stopped jobs, with when they were forgotten, to drop from refreshes that were already under way
+        self._forgotten: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def refresh_sessions(self):
+        started = time.time()
+        user_name = self.beaker.user_name
+        sessions = [(j.id, [_encode(w), _encode(j), _encode(n)]) for w, j, n in iter_sessions(self.beaker, user_name, self.n_workers, MetadataCache())]
+        with self._lock:
+            # a job forgotten while this refresh was listing may still be in it, later refreshes see it stopped
+            forgotten = {job_id for job_id, forgotten_at in self._forgotten.items() if forgotten_at >= started}
+            self._forgotten = {job_id: self._forgotten[job_id] for job_id in forgotten}
+            sessions = [s for job_id, s in sessions if job_id not in forgotten]
+            self.sessions = {"updated": time.time(), "max_age": MAX_AGE_INTERVALS * self.interval, "user_name": user_name, "sessions": sessions}
+
+    def refresh_clusters(self):
+        cache = MetadataCache()
+        clusters = [
+            [_encode(c), [_encode(n) for n in nodes], [_encode(j) for j in jobs]]
+            for c, nodes, jobs in iter_cluster_usage(self.beaker, list_clusters(self.beaker, cache), self.n_workers, cache)
+        ]
+        with self._lock:
+            self.clusters = {"updated": time.time(), "max_age": MAX_AGE_INTERVALS * self.interval, "clusters": clusters}
+
+    def forget_job(self, job_id: str):
+        """Drop a session that was just stopped, rather than showing it until the next refresh."""
+        with self._lock:
+            self._forgotten[job_id] = time.time()
+            if self.sessions is not None:
+                sessions = [s for s in self.sessions["sessions"] if _decode(BeakerJob, s[1]).id != job_id]
+                self.sessions = {**self.sessions, "sessions": sessions}
+
+    def _run(self):
+        while not self._closed.is_set():
+            for refresh in (self.refresh_sessions, self.refresh_clusters):
+                try:
+                    refresh()
+                except Exception as e:
+                    # keep serving the last known state, and try again next time
+                    print(f"Refresh failed: {e!r}", file=sys.stderr)
+            self._closed.wait(self.interval)
+
+    def close(self):
+        self._closed.set()
+
+
+def make_handler(state: DaemonState):
+    class DaemonHandler(StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+            except ValueError:
+                return
+            if request.get("get") in ("sessions", "clusters"):
+                response = getattr(state, request["get"]) or {"error": "not ready yet"}
+            elif request.get("get") == "status":
+                response = {
+                    "pid": os.getpid(),
+                    "interval": state.interval,
+                    "sessions_updated": state.sessions and state.sessions["updated"],
+                    "clusters_updated": state.clusters and state.clusters["updated"],
+                }
+            elif "forget_job" in request:
+                state.forget_job(request["forget_job"])
+                response = {}
+            elif request.get("stop"):
+                # shutdown() waits for the serving loop, which is blocked on this request, so call it elsewhere
+                threading.Thread(target=self.server.shutdown).start()
+                response = {}
+            else:
+                response = {"error": "unknown request"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+    return DaemonHandler
+
+
+def request_daemon(request: dict, socket_path: str | None = None) -> dict | None:
+    """
+    Send a request to the daemon, returning None if it isn't running or doesn't answer in time.
+    """
+    socket_path = socket_path if socket_path is not None else DAEMON_SOCKET_PATH
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CLIENT_TIMEOUT)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                return json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def _get_fresh(entity: str) -> dict | None:
+    response = request_daemon({"get": entity})
+    if response is None or "error" in response or time.time() - response["updated"] > response["max_age"]:
+        return None
+    return response
+
+
+def get_daemon_sessions() -> tuple[str, list[tuple[BeakerWorkload, BeakerJob, BeakerNode | None]]] | None:
+    """
+    The user name and sessions held by a running daemon, or None if there is no daemon or its snapshot is stale.
+    """
+    response = _get_fresh("sessions")
+    if response is None:
+        return None
+    try:
+        sessions = [(_decode(BeakerWorkload, w), _decode(BeakerJob, j), _decode(BeakerNode, n)) for w, j, n in response["sessions"]]
+    except (ValueError, KeyError, TypeError, DecodeError):
+        # a garbled response, e.g. from an incompatible daemon; query the API instead
+        return None
+    return response["user_name"], sessions
+
+
+def get_daemon_clusters() -> list[tuple[BeakerCluster, list[BeakerNode], list[BeakerJob]]] | None:
+    """
+    The clusters with their nodes and unfinalized jobs held by a running daemon, or None if unavailable.
+    """
+    response = _get_fresh("clusters")
+    if response is None:
+        return None
+    try:
+        return [
+            (_decode(BeakerCluster, c), [_decode(BeakerNode, n) for n in nodes], [_decode(BeakerJob, j) for j in jobs])
+            for c, nodes, jobs in response["clusters"]
+        ]
+    except (ValueError, KeyError, TypeError, DecodeError):
+        return None
+
+
+def use_daemon(args) -> bool:
+    # asking for fresh or uncached data bypasses the daemon, just like the on-disk cache
+    return not getattr(args, "refresh", False) and not getattr(args, "no_cache", False)
+
+
+@inject_beaker
+def serve(beaker: Beaker, args):
+    if request_daemon({"get": "status"}) is not None:
+        print(f"A daemon is already listening on {DAEMON_SOCKET_PATH}!")
+        exit(1)
+    os.makedirs(CONF_DIR, exist_ok=True)
+    if os.path.exists(DAEMON_SOCKET_PATH):
+        # left behind by a daemon that didn't shut down cleanly
+        os.unlink(DAEMON_SOCKET_PATH)
+
+    state = DaemonState(beaker, args.refresh_interval, args.n_workers).start()
+    # the socket hands out the user's sessions, so only the user may connect to it
+    old_umask = os.umask(0o177)
+    try:
+        server = ThreadingUnixStreamServer(DAEMON_SOCKET_PATH, make_handler(state))
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    print(f"Listening on {DAEMON_SOCKET_PATH}, refreshing every {args.refresh_interval:g}s")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state.close()
+        server.server_close()
+        if os.path.exists(DAEMON_SOCKET_PATH):
+            os.unlink(DAEMON_SOCKET_PATH)
+
+
+def daemon(args, _):
+    if args.stop:
+        if request_daemon({"stop": True}) is None:
+            print("No daemon is running.")
+            exit(1)
+        print("Stopped the daemon.")
+    elif args.status:
+        status = request_daemon({"get": "status"})
+        if status is None:
+            print("No daemon is running.")
+            exit(1)
+        print(f"Daemon running with pid {status['pid']}, refreshing every {status['interval']:g}s")
+        for entity in ("sessions", "clusters"):
+            updated = status[f"{entity}_updated"]
+            print(f"\t{entity}: " + (f"refreshed {time.time() - updated:.0f}s ago" if updated else "not fetched yet"))
+    else:
+        serve(args)
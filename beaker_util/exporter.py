@@ -0,0 +1,147 @@
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import threading
+import time
+
+from beaker import BeakerJob, BeakerNode
+
+from beaker_util.collectors import HostSample
+from beaker_util.monitor import sample_generator
+from beaker_util.recording import parse_job_usage
+
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# name -> (type, help)
+METRICS = {
+    "beakerutil_job_cpu_percent": ("gauge", "CPU usage of the job's container, in percent of one core"),
+    "beakerutil_job_memory_bytes": ("gauge", "Memory used by the job's container"),
+    "beakerutil_job_network_receive_bytes": ("counter", "Bytes received by the job's container"),
+    "beakerutil_job_network_transmit_bytes": ("counter", "Bytes sent by the job's container"),
+    "beakerutil_job_block_read_bytes": ("counter", "Bytes read from block devices by the job's container"),
+    "beakerutil_job_block_write_bytes": ("counter", "Bytes written to block devices by the job's container"),
+    "beakerutil_gpu_utilization_percent": ("gauge", "Utilization of a GPU assigned to the job"),
+    "beakerutil_gpu_memory_used_bytes": ("gauge", "Memory used on a GPU assigned to the job"),
+    "beakerutil_gpu_memory_total_bytes": ("gauge", "Total memory of a GPU assigned to the job"),
+    "beakerutil_host_stale": ("gauge", "Whether the host missed its latest collection deadline (1) or not (0)"),
+    "beakerutil_host_last_update_timestamp_seconds": ("gauge", "When the host last reported usage"),
+    "beakerutil_last_collection_timestamp_seconds": ("gauge", "When the exporter last finished a collection round"),
+}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    return "NaN" if math.isnan(value) else repr(float(value))
+
+
+def render_metrics(experiments: list[tuple[BeakerJob, BeakerNode]], samples: dict[str, HostSample], collected: float) -> bytes:
+    """
+    Render the latest samples in the OpenMetrics text format.
+    """
+    values: dict[str, list[tuple[dict[str, str], float]]] = {name: [] for name in METRICS}
+    for hostname, sample in samples.items():
+        values["beakerutil_host_stale"].append(({"hostname": hostname}, float(sample.stale)))
+        values["beakerutil_host_last_update_timestamp_seconds"].append(({"hostname": hostname}, sample.updated))
+    for job, node in experiments:
+        sample = samples.get(node.hostname)
+        if sample is None or (usage := parse_job_usage(job, sample)) is None:
+            continue
+        labels = {"job_id": job.id, "hostname": node.hostname}
+        values["beakerutil_job_cpu_percent"].append((labels, usage["cpu_percent"]))
+        values["beakerutil_job_memory_bytes"].append((labels, usage["memory_bytes"]))
+        values["beakerutil_job_network_receive_bytes"].append((labels, usage["network_receive_bytes"]))
+        values["beakerutil_job_network_transmit_bytes"].append((labels, usage["network_transmit_bytes"]))
+        values["beakerutil_job_block_read_bytes"].append((labels, usage["block_read_bytes"]))
+        values["beakerutil_job_block_write_bytes"].append((labels, usage["block_write_bytes"]))
+        for gpu in usage["gpus"]:
+            gpu_labels = {**labels, "gpu_uuid": gpu["uuid"], "gpu_name": gpu["name"]}
+            values["beakerutil_gpu_utilization_percent"].append((gpu_labels, gpu["utilization_percent"]))
+            values["beakerutil_gpu_memory_used_bytes"].append((gpu_labels, gpu["memory_used_bytes"]))
+            values["beakerutil_gpu_memory_total_bytes"].append((gpu_labels, gpu["memory_total_bytes"]))
+    values["beakerutil_last_collection_timestamp_seconds"].append(({}, collected))
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"# HELP {name} {help_text}")
+        sample_name = f"{name}_total" if metric_type == "counter" else name
+        for labels, value in values[name]:
+            label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{sample_name}{{{label_str}}} {_format_value(value)}" if label_str else f"{sample_name} {_format_value(value)}")
+    lines.append("# EOF")
+    return ("\n".join(lines) + "\n").encode()
+
+
+class MetricsCache:
+    """
+    Latest rendered metrics, refreshed by the collection loop. Scrapes only ever read from here.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._body = b"# EOF\n"
+
+    def set(self, body: bytes):
+        with self._lock:
+            self._body = body
+
+    def get(self) -> bytes:
+        with self._lock:
+            return self._body
+
+
+def make_handler(cache: MetricsCache):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = cache.get()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are frequent, don't spam the terminal
+            pass
+
+    return MetricsHandler
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+def serve(args):
+    try:
+        host, port = parse_address(args.serve)
+    except ValueError:
+        print(f"Invalid address {args.serve}, expected [HOST]:PORT!")
+        exit(1)
+
+    cache = MetricsCache()
+    server = ThreadingHTTPServer((host, port), make_handler(cache))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics at http://{host or '0.0.0.0'}:{port}/metrics")
+
+    try:
+        with closing(sample_generator(args.stream, args.interval, args.host_timeout, args.discovery_interval, args.record, args.max_hosts)) as gen:
+            while True:
+                loop_start = time.perf_counter()
+                experiments, samples = next(gen)
+                cache.set(render_metrics(experiments, samples, time.time()))
+                sleep_time = args.interval - (time.perf_counter() - loop_start)
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+from collections import defaultdict
+import os
+import re
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Iterable
+
+from tabulate import tabulate
+
+from beaker_util.utils import get_node_gpu_usage, print_ndjson
+
+if TYPE_CHECKING:
+    # numpy is only needed for `clusters history`, so that `clusters --sample` and plain `clusters` don't import it
+    import numpy as np
+    from beaker import BeakerCluster, BeakerJob, BeakerNode
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    cluster TEXT NOT NULL,
+    gpus INTEGER NOT NULL,
+    used_gpus INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_cluster_time ON samples (cluster, time);
+CREATE INDEX IF NOT EXISTS samples_time ON samples (time);
+CREATE TABLE IF NOT EXISTS node_samples (
+    sample_id INTEGER NOT NULL REFERENCES samples (id),
+    node TEXT NOT NULL,
+    gpus INTEGER NOT NULL,
+    free_gpus INTEGER NOT NULL,
+    cordoned INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS node_samples_sample ON node_samples (sample_id);
+"""
+
+HISTORY_PERCENTILES = (10, 50, 90)
+
+
+def open_history(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # cron runs may overlap with a query, so wait for the other connection rather than failing
+    conn = sqlite3.connect(path, timeout=30)
+    conn.executescript(HISTORY_SCHEMA)
+    return conn
+
+
+def record_samples(conn: sqlite3.Connection, cluster_usage: Iterable[tuple[BeakerCluster, list[BeakerNode], list[BeakerJob]]],
+                   sample_time: float) -> tuple[int, int]:
+    """
+    Append the GPU availability of each cluster and its GPU nodes at `sample_time`, in one transaction.
+    Returns the number of clusters and nodes recorded.
+    """
+    # fetch everything first, so that the database is only locked for the inserts and not while waiting on the API
+    samples = []
+    for cluster, nodes, jobs in cluster_usage:
+        node_usage = get_node_gpu_usage(nodes, jobs)
+        node_rows = [
+            (node.hostname, total, total - used, node.cordon_details.HasField("cordoned"))
+            for node in nodes if node.id in node_usage
+            for total, used in [node_usage[node.id]]
+        ]
+        samples.append(((sample_time, cluster.name, sum(t for t, _ in node_usage.values()), sum(u for _, u in node_usage.values())), node_rows))
+
+    with conn:
+        for sample_row, node_rows in samples:
+            sample_id = conn.execute("INSERT INTO samples (time, cluster, gpus, used_gpus) VALUES (?, ?, ?, ?)", sample_row).lastrowid
+            conn.executemany(
+                "INSERT INTO node_samples (sample_id, node, gpus, free_gpus, cordoned) VALUES (?, ?, ?, ?, ?)",
+                [(sample_id, *row) for row in node_rows],
+            )
+    return len(samples), sum(len(node_rows) for _, node_rows in samples)
+
+
+def load_cluster_history(conn: sqlite3.Connection, cluster: str, since: float, gpus: int | None) -> np.ndarray:
+    """
+    The samples of a cluster since the given time, as rows of (time, free GPUs, uncordoned nodes with `gpus` free GPUs).
+    The last column is NaN if `gpus` isn't given.
+    """
+    import numpy as np
+
+    if gpus is None:
+        rows = conn.execute(
+            "SELECT time, gpus - used_gpus, NULL FROM samples WHERE cluster = ? AND time >= ? ORDER BY time",
+            (cluster, since),
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT s.time, s.gpus - s.used_gpus, COUNT(n.sample_id) FROM samples s "
+            "LEFT JOIN node_samples n ON n.sample_id = s.id AND n.free_gpus >= ? AND NOT n.cordoned "
+            "WHERE s.cluster = ? AND s.time >= ? GROUP BY s.id ORDER BY s.time",
+            (gpus, cluster, since),
+        ).fetchall()
+    return np.array(rows, dtype=float).reshape(-1, 3)
+
+
+def summarize_history(samples: np.ndarray, trend_hours: float) -> dict:
+    """
+    Percentiles of free GPUs (and fitting nodes) by local hour of day, and the current level and trend,
+    which is the slope of a line fit through the samples of the last `trend_hours` hours.
+    """
+    import numpy as np
+
+    by_hour = defaultdict(list)
+    for sample in samples:
+        by_hour[time.localtime(sample[0]).tm_hour].append(sample)
+    hours = []
+    for hour in sorted(by_hour):
+        hour_samples = np.array(by_hour[hour])
+        record = {"hour": hour, "samples": len(hour_samples)}
+        record.update({f"free_gpus_p{p}": v for p, v in zip(HISTORY_PERCENTILES, np.percentile(hour_samples[:, 1], HISTORY_PERCENTILES))})
+        if not np.isnan(hour_samples[0, 2]):
+            record.update({f"nodes_p{p}": v for p, v in zip(HISTORY_PERCENTILES, np.percentile(hour_samples[:, 2], HISTORY_PERCENTILES))})
+        hours.append(record)
+
+    recent = samples[samples[:, 0] >= samples[-1, 0] - trend_hours * 3600]
+    # a trend needs samples spread over some time, not just a couple taken back to back
+    if len(recent) >= 3 and recent[-1, 0] - recent[0, 0] >= 600:
+        trend = np.polyfit((recent[:, 0] - recent[-1, 0]) / 3600, recent[:, 1], 1)[0]
+    else:
+        trend = None
+    return {
+        "last_sample": samples[-1, 0],
+        "free_gpus": samples[-1, 1],
+        "nodes": None if np.isnan(samples[-1, 2]) else samples[-1, 2],
+        "trend_free_gpus_per_hour": trend,
+        "hours": hours,
+    }
+
+
+def format_history(cluster: str, summary: dict, gpus: int | None, trend_hours: float) -> str:
+    age_minutes = (time.time() - summary["last_sample"]) / 60
+    now_str = f"{summary['free_gpus']:g} free GPU(s)"
+    if summary["nodes"] is not None:
+        now_str += f", {summary['nodes']:g} node(s) with {gpus} free"
+    if summary["trend_free_gpus_per_hour"] is None:
+        trend_str = f"not enough samples in the last {trend_hours:g}h for a trend"
+    else:
+        trend_str = f"trend over the last {trend_hours:g}h: {summary['trend_free_gpus_per_hour']:+.1f} free GPUs/hour"
+    headers = ["Hour", "Samples"] + [f"Free GPUs p{p}" for p in HISTORY_PERCENTILES]
+    if gpus is not None:
+        headers += [f"Nodes with {gpus} free p{p}" for p in HISTORY_PERCENTILES]
+    rows = [
+        [f"{h['hour']:02d}:00", h["samples"]]
+        + [h[f"free_gpus_p{p}"] for p in HISTORY_PERCENTILES]
+        + ([h[f"nodes_p{p}"] for p in HISTORY_PERCENTILES] if gpus is not None else [])
+        for h in summary["hours"]
+    ]
+    table = tabulate(rows, headers=headers, floatfmt="g")
+    return f"{cluster}: {now_str} as of {age_minutes:.0f} minute(s) ago, {trend_str}\n{table}"
+
+
+def history(args, _):
+    if not os.path.exists(args.history_db):
+        print(f"No cluster history found at {args.history_db}! Record some with `beakerutil clusters --sample`.")
+        exit(1)
+    conn = open_history(args.history_db)
+    since = time.time() - args.days * 24 * 3600
+    # served from the (cluster, time) index
+    names = [name for name, in conn.execute("SELECT DISTINCT cluster FROM samples ORDER BY cluster")]
+    names = [name for name in names if not args.pattern or re.match(args.pattern, name)]
+
+    n_printed = 0
+    for name in names:
+        samples = load_cluster_history(conn, name, since, args.gpus)
+        if len(samples) == 0:
+            continue
+        summary = summarize_history(samples, args.trend_hours)
+        if args.format == "ndjson":
+            print_ndjson({"name": name, **summary})
+        else:
+            print(("\n" if n_printed > 0 else "") + format_history(name, summary, args.gpus, args.trend_hours))
+        n_printed += 1
+    if n_printed == 0 and args.format != "ndjson":
+        print(f"No samples of matching clusters in the last {args.days:g} day(s).")
@@ -0,0 +1,257 @@
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+import os
+import subprocess
+import time
+from typing import Iterable
+import uuid
+
+from beaker import Beaker, BeakerCluster, BeakerJob, BeakerWorkload, BeakerWorkloadStatus, BeakerWorkloadType
+import yaml
+
+from beaker_util.cache import MetadataCache
+from beaker_util.config import DEFAULT_LAUNCH_CONFIG, LAUNCH_CONF_PATH
+from beaker_util.daemon import get_daemon_clusters, use_daemon
+from beaker_util.tracing import report_trace
+from beaker_util.utils import (
+    ConfigDumper, find_clusters, inject_beaker, iter_cluster_usage, merge_configs, rank_clusters_by_availability, resolve_latest_jobs,
+)
+
+# Seconds to wait for `beaker session create --detach` to submit a session
+SUBMIT_TIMEOUT = 120
+# Seconds between polls of racing sessions, backing off from the initial to the maximum interval
+RACE_POLL_INITIAL = 1
+RACE_POLL_MAX = 10
+# Seconds a submitted session may take to show up in the API before it is given up on
+RACE_DISCOVERY_TIMEOUT = 60
+
+
+def best_clusters(beaker: Beaker, args, clusters: list[BeakerCluster], gpus: int, n_best: int) -> list[BeakerCluster]:
+    """
+    The `n_best` clusters with the most nodes that can currently fit the session, in ranked order.
+    Clusters with no such node are only kept if none of the clusters has one, in which case the session will queue anyway.
+    """
+    cluster_ids = {c.id for c in clusters}
+    if use_daemon(args) and (daemon_clusters := get_daemon_clusters()) is not None and cluster_ids <= {c.id for c, _, _ in daemon_clusters}:
+        cluster_usage = [u for u in daemon_clusters if u[0].id in cluster_ids]
+    else:
+        cluster_usage = iter_cluster_usage(beaker, clusters, cache=MetadataCache.from_args(args))
+    ranked = rank_clusters_by_availability(cluster_usage, gpus)
+    if ranked[0][1] > 0:
+        ranked = [(c, n_fit) for c, n_fit in ranked if n_fit > 0]
+    ranked = ranked[:n_best]
+    requirement = f"with {gpus} free GPU(s)" if gpus > 0 else "available"
+    print(f"Best clusters by nodes {requirement}: " + ", ".join(f"{c.name} ({n_fit} nodes)" for c, n_fit in ranked))
+    return [c for c, _ in ranked]
+
+
+def session_command(launch_conf: dict, clusters: list[BeakerCluster], extra_args: list[str]) -> str:
+    beaker_cmd = f"beaker session create -w {launch_conf['workspace']} --budget {launch_conf['budget']} --remote --bare"
+    for cluster in clusters:
+        beaker_cmd += f" --cluster {cluster.organization_name}/{cluster.name}"
+    for mount in launch_conf.get("mounts", []):
+        beaker_cmd += f" --mount src={mount['src']},ref={mount['ref']},dst={mount['dst']}"
+    for env, secret in launch_conf.get("env_secrets", {}).items():
+        beaker_cmd += f" --secret-env {env}={secret}"
+    if "gpus" in launch_conf:
+        beaker_cmd += f" --gpus {launch_conf['gpus']}"
+    if "port" in launch_conf:
+        beaker_cmd += f" --port {launch_conf['port']}"
+
+    if len(extra_args) > 0:
+        beaker_cmd += f" {' '.join(extra_args)}"
+    return beaker_cmd
+
+
+def submit_session(cmd: str) -> str | None:
+    """
+    Run a detached `beaker session create`, returning its error output if it failed.
+    """
+    try:
+        result = subprocess.run(cmd.split(), capture_output=True, text=True, timeout=SUBMIT_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return str(e)
+    return (result.stderr.strip() or result.stdout.strip() or f"exit code {result.returncode}") if result.returncode != 0 else None
+
+
+def find_sessions(beaker: Beaker, names: Iterable[str], workloads: dict[str, BeakerWorkload | None]):
+    """
+    Add the unfinished sessions with the given names to `workloads`, by name.
+    """
+    names = set(names)
+    for w in beaker.workload.list(author=beaker.user_name, finalized=False, workload_type=BeakerWorkloadType.environment):
+        if w.environment.name in names:
+            workloads[w.environment.name] = w
+
+
+def wait_for_first_node(beaker: Beaker, names: dict[str, BeakerCluster], workloads: dict[str, BeakerWorkload | None]) -> tuple[str, BeakerJob]:
+    """
+    Poll the sessions with the given names (with backoff) until one of them is assigned a node, returning its name and job.
+    The workloads of the sessions are added to `workloads` as they show up, so the caller can cancel them even if this fails.
+    Sessions that finish are set to None there. Exits if every session finishes, or never shows up, without getting a node.
+    """
+    names = dict(names)
+    statuses: dict[str, str] = {}
+    delay = RACE_POLL_INITIAL
+    submitted = time.time()
+    while True:
+        if not names.keys() <= workloads.keys():
+            find_sessions(beaker, names.keys() - workloads.keys(), workloads)
+            if not names.keys() <= workloads.keys() and time.time() - submitted > RACE_DISCOVERY_TIMEOUT:
+                for name in names.keys() - workloads.keys():
+                    print(f"Session {name} on {names.pop(name).name} never showed up, ignoring it.")
+
+        racing = [name for name in names if name in workloads]
+        for name, job in zip(racing, resolve_latest_jobs(beaker, [workloads[name] for name in racing])):
+            if job is None:
+                continue
+            if job.assignment_details.node_id:
+                return name, job
+            if job.status.HasField("finalized"):
+                print(f"Session on {names.pop(name).name} finished without getting a node.")
+                workloads[name] = None
+                continue
+            status = BeakerWorkloadStatus(job.status.status).name
+            if statuses.get(name) != status:
+                print(f"\t{names[name].name}: {status}")
+                statuses[name] = status
+        if len(names) == 0:
+            print("None of the sessions got a node!")
+            exit(1)
+
+        time.sleep(delay)
+        delay = min(delay * 2, RACE_POLL_MAX)
+
+
+def cancel_racing_sessions(beaker: Beaker, names: dict[str, BeakerCluster], workloads: dict[str, BeakerWorkload | None],
+                           keep: str | None, discovery_deadline: float):
+    """
+    Cancel every racing session except `keep`. A session can show up in the API well after it was submitted, and still
+    get a node (and hold its GPUs) after the race is over, so the ones that haven't shown up yet are looked for by name
+    and cancelled as they appear, until `discovery_deadline`.
+    """
+    pending = set(names) - {keep}
+    delay = RACE_POLL_INITIAL
+    while True:
+        found = [name for name in pending if workloads.get(name) is not None]
+        if found:
+            try:
+                beaker.workload.cancel(*(workloads[name] for name in found))
+            except Exception as e:
+                print(f"Failed to cancel {', '.join(found)}, cancel them manually: {e!r}")
+        # cancelled, finished, or reported above
+        pending -= workloads.keys()
+        if len(pending) == 0:
+            return
+        if time.time() > discovery_deadline:
+            for name in pending:
+                print(f"Session {name} never showed up on {names[name].name}, cancel it manually if it does.")
+            return
+        if delay == RACE_POLL_INITIAL:
+            print(f"Waiting for {len(pending)} session(s) to show up so that they can be cancelled...")
+        time.sleep(delay)
+        delay = min(delay * 2, RACE_POLL_MAX)
+        find_sessions(beaker, pending, workloads)
+
+
+def race_launch(beaker: Beaker, args, launch_conf: dict, clusters: list[BeakerCluster], extra_args: list[str]):
+    """
+    Submit the session to each of the clusters at once, keep whichever gets a node first, cancel the others, and attach to it.
+    """
+    if any(a in ("-n", "--name") or a.startswith("--name=") for a in extra_args):
+        print("Sessions launched with --race are named by beakerutil, remove the name from the extra arguments!")
+        exit(1)
+    if args.race < 1:
+        print(f"The number of clusters to race must be positive, got {args.race}!")
+        exit(1)
+    clusters = best_clusters(beaker, args, clusters, int(launch_conf.get("gpus", 0)), args.race)
+
+    # the sessions are told apart by name, since `beaker session create` doesn't report what it created
+    token = uuid.uuid4().hex[:8]
+    names = {f"{args.launch_config}-{token}-{i}": c for i, c in enumerate(clusters)}
+    commands = {name: session_command(launch_conf, [c], ["--name", name, "--detach"] + extra_args) for name, c in names.items()}
+    if args.dry_run:
+        print("Would execute, keeping the first session to get a node:")
+        for cmd in commands.values():
+            print(cmd)
+        return
+
+    workloads: dict[str, BeakerWorkload | None] = {}
+    winner_name = None
+    submitted_at = None
+    try:
+        with ThreadPoolExecutor(len(commands)) as executor:
+            errors = dict(zip(commands, executor.map(submit_session, commands.values())))
+        submitted_at = time.time()
+        for name, error in errors.items():
+            if error is not None:
+                print(f"Failed to submit to {names[name].name}: {error}")
+        names = {name: c for name, c in names.items() if errors[name] is None}
+        if len(names) == 0:
+            exit(1)
+
+        print(f"Submitted to {', '.join(c.name for c in names.values())}, waiting for a node...")
+        winner_name, winner = wait_for_first_node(beaker, names, workloads)
+    finally:
+        # also runs when interrupted (even while submitting, in which case any of the sessions may have been created)
+        # or when no session got a node, so that nothing is left queued
+        discovery_deadline = (submitted_at or time.time()) + RACE_DISCOVERY_TIMEOUT
+        cancel_racing_sessions(beaker, names, workloads, winner_name, discovery_deadline)
+
+    print(f"Session {winner_name} got a node on {names[winner_name].name}, cancelled the others. Attaching...")
+    report_trace()
+    os.execlp("beaker", *f"beaker session attach --remote {winner.id}".split())
+
+
+@inject_beaker
+def launch_interactive(beaker: Beaker, args, extra_args: list[str]):
+    try:
+        with open(LAUNCH_CONF_PATH, "r") as f:
+            conf: dict[str, dict[str, str]] = yaml.safe_load(f)
+    except FileNotFoundError:
+        print(f"No launch configuration found at {LAUNCH_CONF_PATH}! Create one to use this command.")
+        exit(1)
+
+    if args.launch_config not in conf or args.launch_config == DEFAULT_LAUNCH_CONFIG:
+        available_launch_configs = ", ".join(sorted(conf.keys() - {DEFAULT_LAUNCH_CONFIG}))
+        print(f"No launch configuration found for {args.launch_config}! Available configurations: {available_launch_configs}")
+        exit(1)
+
+    launch_conf = merge_configs(conf[args.launch_config], conf.get(DEFAULT_LAUNCH_CONFIG, {}))
+
+    clusters = find_clusters(beaker, launch_conf["cluster"], MetadataCache.from_args(args))
+    if len(clusters) == 0:
+        print(f"No clusters found for pattern {launch_conf['cluster']}!")
+        exit(1)
+
+    if args.race is not None:
+        race_launch(beaker, args, launch_conf, clusters, extra_args)
+        return
+
+    n_best = args.best if args.best is not None else launch_conf.get("best_clusters")
+    if n_best is not None:
+        if int(n_best) < 1:
+            print(f"The number of best clusters to launch on must be positive, got {n_best}!")
+            exit(1)
+        clusters = best_clusters(beaker, args, clusters, int(launch_conf.get("gpus", 0)), int(n_best))
+
+    beaker_cmd = session_command(launch_conf, clusters, extra_args)
+    if args.dry_run:
+        print("Would execute:")
+        print(beaker_cmd)
+    else:
+        print(*beaker_cmd.split())
+        report_trace()
+        os.execlp("beaker", *beaker_cmd.split())
+
+
+def view_config(args, _):
+    if args.config_type == "launch":
+        with open(LAUNCH_CONF_PATH, "r") as f:
+            launch_conf: dict[str, dict] = yaml.safe_load(f)
+        default_conf = launch_conf.pop(DEFAULT_LAUNCH_CONFIG, {})
+        for conf in launch_conf.values():
+            conf.update(deepcopy(default_conf))
+        print(yaml.dump(launch_conf, indent=4, Dumper=ConfigDumper))
+    else:
+        raise ValueError(f"Unknown configuration type: {args.config_type}")
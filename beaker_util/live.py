@@ -0,0 +1,54 @@
+import os
+import shutil
+import sys
+import time
+from typing import Callable, TextIO
+
+
+class LiveBlock:
+    """
+    Redraws a block of lines in place on a terminal as partial results come in, then prints the final lines once done.
+    When not writing to a terminal, only the final lines are printed, so piped output is unaffected.
+    """
+
+    def __init__(self, stream: TextIO | None = None):
+        # looked up when created, so that redirecting sys.stdout is respected
+        self.stream = stream if stream is not None else sys.stdout
+        self.enabled = self.stream.isatty() and os.environ.get("TERM") != "dumb"
+        self._drawn = 0
+        self._last_draw = 0.0
+        self._render_time = 0.0
+
+    def update(self, render: Callable[[], list[str]]):
+        """
+        Redraw the block with the lines returned by `render`. Redraws are skipped while they'd take up more than a
+        fraction of the time, so that rendering large outputs doesn't slow down resolving them.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if now - self._last_draw < 4 * self._render_time:
+            return
+        lines = render()
+        width, height = shutil.get_terminal_size()
+        # the cursor can only be moved back over lines still on screen, so clip to the terminal
+        lines = [line.expandtabs()[:width - 1] for line in lines]
+        if len(lines) > height - 1:
+            lines = lines[:height - 2] + [f"... ({len(lines) - height + 2} more lines)"]
+        self._clear()
+        self.stream.write("".join(line + "\n" for line in lines))
+        self.stream.flush()
+        self._drawn = len(lines)
+        self._last_draw = time.perf_counter()
+        self._render_time = self._last_draw - now
+
+    def _clear(self):
+        if self._drawn > 0:
+            # move to the start of the first drawn line and clear everything below it
+            self.stream.write(f"\x1b[{self._drawn}F\x1b[J")
+            self._drawn = 0
+
+    def finish(self, lines: list[str]):
+        self._clear()
+        self.stream.write("".join(line + "\n" for line in lines))
+        self.stream.flush()
@@ -1,128 +1,392 @@
-import io
+import math
+import threading
 import time
 import curses
 from datetime import datetime
 from contextlib import closing
-from concurrent.futures import ThreadPoolExecutor
 
-import fabric
 from beaker import Beaker, BeakerJob, BeakerNode, BeakerWorkloadStatus, BeakerWorkloadType
-import pandas as pd
 from tabulate import tabulate
 
-from beaker_util.utils import inject_beaker
+from beaker_util.collectors import DEFAULT_MAX_HOSTS, HostSample, PollingCollector, StreamingCollector
+from beaker_util.recording import Recorder, parse_job_usage, parse_number, parse_size
+from beaker_util.utils import inject_beaker, print_ndjson, resolve_latest_jobs, resolve_nodes
 
 
-@inject_beaker
-def usage_generator(beaker: Beaker):
-    workloads = beaker.workload.list(author=beaker.user_name, finalized=False, workload_type=BeakerWorkloadType.experiment)
-
-    experiments: list[tuple[BeakerJob, BeakerNode]] = []
-    for workload in workloads:
-        job = beaker.workload.get_latest_job(workload)
-        if job is not None and job.status.status == BeakerWorkloadStatus.running:
-            experiments.append((job, beaker.node.get(job.assignment_details.node_id)))
+# Seconds to wait for a host to report before showing its last known values as stale
+DEFAULT_HOST_TIMEOUT = 5
+# Seconds between background refreshes of the list of running experiments
+DEFAULT_DISCOVERY_INTERVAL = 30
+# Milliseconds the UI waits for a keypress before checking for new data
+UI_TICK_MS = 100
+
+
+def get_running_experiments(beaker: Beaker) -> list[tuple[BeakerJob, BeakerNode]]:
+    workloads = list(beaker.workload.list(author=beaker.user_name, finalized=False, workload_type=BeakerWorkloadType.experiment))
+    jobs = [j for j in resolve_latest_jobs(beaker, workloads) if j is not None and j.status.status == BeakerWorkloadStatus.running]
+    nodes = resolve_nodes(beaker, jobs)
+
+    experiments = [(j, nodes[j.assignment_details.node_id]) for j in jobs]
     experiments.sort(key=lambda x: x[1].hostname + x[0].id)
+    return experiments
+
+
+class ExperimentDiscovery:
+    """
+    Re-lists the running experiments in the background every `interval` seconds,
+    adding and removing hosts from the collector as jobs start and finish.
+    """
+
+    def __init__(self, beaker: Beaker, experiments: list[tuple[BeakerJob, BeakerNode]], collector: PollingCollector | StreamingCollector, interval: float):
+        self.beaker = beaker
+        self.experiments = experiments
+        self.collector = collector
+        self.interval = interval
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            try:
+                experiments = get_running_experiments(self.beaker)
+            except Exception:
+                # keep showing the last known experiments, and try again next time
+                continue
+            hostnames = sorted(set(n.hostname for _, n in experiments))
+            if hostnames != self.collector.hosts:
+                self.collector.set_hosts(hostnames)
+            # replaced wholesale, so readers always see a consistent list
+            self.experiments = experiments
+
+    def close(self):
+        self._closed.set()
+
+
+USAGE_HEADERS = ["Job", "Hostname", "CPU %", "RAM", "GPU(s)", "GPU %", "VRAM", "Network (In/Out)", "Disk (Write/Read)"]
+
 
+def get_usage_rows(experiments: list[tuple[BeakerJob, BeakerNode]], samples: dict[str, HostSample]) -> list[list[str]]:
+    """
+    Build one row (matching USAGE_HEADERS) per running experiment from the latest per-host samples.
+    """
+    rows = []
+    for job, node in experiments:
+        hostname = node.hostname
+        sample = samples.get(hostname)
+        if sample is None:
+            # the host hasn't reported yet (or is unreachable), so we can't tell whether the job is still running
+            rows.append([job.id, f"{hostname} (no data)", "", "", "", "", "", "", ""])
+            continue
+
+        gpus: list[str] = []
+        vram: list[str] = []
+        gpu_util: list[str] = []
+        if job.assignment_details.HasField("resource_assignment"):
+            for gpu in job.assignment_details.resource_assignment.gpus:
+                if (row := sample.gpus.get(gpu)) is None:
+                    continue
+                gpus.append(row["name"])
+                vram.append(f"{row['memory.used [MiB]']} / {row['memory.total [MiB]']}")
+                gpu_util.append(row['utilization.gpu [%]'])
+
+        docker_row = sample.containers.get(f"execution-{job.id}".lower())
+        if docker_row is None:
+            continue
+        cpu_util: str = docker_row["CPUPerc"]
+        ram: str = docker_row["MemUsage"]
+        network_io: str = docker_row["NetIO"]
+        disk_io: str = docker_row["BlockIO"]
+
+        if sample.stale:
+            hostname += f" (stale, {datetime.fromtimestamp(sample.updated).strftime('%H:%M:%S')})"
+        rows.append([job.id, hostname, cpu_util, ram, "\n".join(gpus), "\n".join(gpu_util), "\n".join(vram), network_io, disk_io])
+    return rows
+
+
+def format_usage(timestamp: datetime, rows: list[list[str]]) -> str:
+    table = tabulate(rows, headers=USAGE_HEADERS, tablefmt="grid")
+    return f"{timestamp.strftime('%m/%d/%Y %H:%M:%S')}\n{table}"
+
+
+@inject_beaker
+def sample_generator(beaker: Beaker, stream: bool = False, interval: float = 2, timeout: float = DEFAULT_HOST_TIMEOUT,
+                     discovery_interval: float = DEFAULT_DISCOVERY_INTERVAL, record: str | None = None,
+                     max_hosts: int = DEFAULT_MAX_HOSTS):
+    """
+    Yields (experiments, samples) for every collection round, forever. This is the collection pipeline shared by
+    every way of consuming monitor data.
+    """
+    recorder = Recorder(record) if record is not None else None
+    experiments = get_running_experiments(beaker)
     hostnames = sorted(set(n.hostname for _, n in experiments))
-    with closing(fabric.ThreadingGroup(*hostnames, forward_agent=False)) as smi_connections:
-        with closing(fabric.ThreadingGroup(*hostnames, forward_agent=False)) as docker_connections:
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                while True:
-                    smi_output_fut = executor.submit(smi_connections.run, "nvidia-smi --query-gpu=uuid,name,memory.used,memory.total,utilization.gpu --format=csv", hide=True)
-                    docker_output_fut = executor.submit(docker_connections.run, "docker stats --no-stream --no-trunc --format json", hide=True)
-                    smi_output = smi_output_fut.result()
-                    docker_output = docker_output_fut.result()
-                    assert isinstance(smi_output, fabric.GroupResult)
-                    assert isinstance(docker_output, fabric.GroupResult)
-                    node_smi_output: dict[str, pd.DataFrame] = {}
-                    for conn, output in smi_output.items():
-                        conn: fabric.Connection
-                        output: fabric.Result
-                        assert isinstance(conn.host, str) and isinstance(output.stdout, str)
-                        node_smi_output[conn.host] = pd.read_csv(io.StringIO(output.stdout), skipinitialspace=True)
-                        node_smi_output[conn.host].set_index("uuid", inplace=True)
-                    node_docker_output: dict[str, pd.DataFrame] = {}
-                    for conn, output in docker_output.items():
-                        conn: fabric.Connection
-                        output: fabric.Result
-                        assert isinstance(conn.host, str) and isinstance(output.stdout, str)
-                        node_docker_output[conn.host] = pd.read_json(io.StringIO(output.stdout), lines=True)
-                        node_docker_output[conn.host].set_index("Name", inplace=True)
-
-                    rows = [["Job", "Hostname", "CPU %", "RAM", "GPU(s)", "GPU %", "VRAM", "Network (In/Out)", "Disk (Write/Read)"]]
-                    for job, node in experiments:
-                        hostname = node.hostname
-                        gpus: list[str] = []
-                        vram: list[str] = []
-                        gpu_util: list[str] = []
-                        if job.assignment_details.HasField("resource_assignment"):
-                            smi_df = node_smi_output[hostname]
-                            for gpu in job.assignment_details.resource_assignment.gpus:
-                                row = smi_df.loc[gpu]
-                                gpus.append(row["name"])
-                                vram.append(f"{row['memory.used [MiB]']} / {row['memory.total [MiB]']}")
-                                gpu_util.append(row['utilization.gpu [%]'])
-
-                        docker_df = node_docker_output[hostname]
-                        try:
-                            docker_row = docker_df.loc[f"execution-{job.id}".lower()]
-                        except KeyError:
-                            continue
-                        cpu_util: str = docker_row["CPUPerc"]
-                        ram: str = docker_row["MemUsage"]
-                        network_io: str = docker_row["NetIO"]
-                        disk_io: str = docker_row["BlockIO"]
-
-                        rows.append([job.id, hostname, cpu_util, ram, "\n".join(gpus), "\n".join(gpu_util), "\n".join(vram), network_io, disk_io])
-                    if len(rows) == 1:
-                        break
-                    timestamp = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
-                    table = tabulate(rows, headers="firstrow", tablefmt="grid")
-                    yield f"{timestamp}\n{table}"
+    if stream:
+        collector = StreamingCollector(hostnames, interval, stale_after=max(timeout, 3 * interval), max_hosts=max_hosts).start()
+    else:
+        collector = PollingCollector(hostnames, timeout, max_hosts)
+    with closing(collector), closing(ExperimentDiscovery(beaker, experiments, collector, discovery_interval).start()) as discovery:
+        if stream:
+            # give every host a chance to report before the first frame
+            collector.wait_ready(timeout)
+        while True:
+            experiments, samples = discovery.experiments, collector.collect()
+            if recorder is not None:
+                recorder.record(experiments, samples)
+            yield experiments, samples
+
+
+def usage_generator(*args, **kwargs):
+    """
+    Yields (timestamp, rows) for every collection round, until none of the experiments are running anymore.
+    """
+    with closing(sample_generator(*args, **kwargs)) as samples_gen:
+        for experiments, samples in samples_gen:
+            rows = get_usage_rows(experiments, samples)
+            if len(rows) == 0:
+                break
+            yield datetime.now(), rows
+
+
+def usage_sort_key(cell: str):
+    # sort by the first quantity in the cell (e.g. the used part of "793.5MiB / 1.968TiB"), falling back to text
+    first = cell.split("\n")[0].split("/")[0]
+    value = parse_size(first)
+    if math.isnan(value):
+        value = parse_number(first)
+    return (0, value, cell) if not math.isnan(value) else (1, 0.0, cell)
+
+
+class UsageCollector:
+    """
+    Runs the usage generator on a background thread, so that the UI stays responsive while a round is being collected.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.latest: tuple[datetime, list[list[str]]] | None = None
+        self.collecting = False
+        self.finished = False
+        self.error: BaseException | None = None
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        args = self.args
+        try:
+            with closing(usage_generator(args.stream, args.interval, args.host_timeout, args.discovery_interval, args.record, args.max_hosts)) as gen:
+                while not self._closed.is_set():
+                    loop_start = time.perf_counter()
+                    self.collecting = True
+                    try:
+                        self.latest = next(gen)
+                    except StopIteration:
+                        self.finished = True
+                        return
+                    finally:
+                        self.collecting = False
+                    self._closed.wait(args.interval - (time.perf_counter() - loop_start))
+        except Exception as e:
+            self.error = e
+
+    def close(self, timeout: float):
+        self._closed.set()
+        self._thread.join(timeout)
+
+
+class UsageView:
+    """
+    Interactive curses view of the usage table, redrawing only the lines that changed since the last frame.
+    """
+
+    HELP = "q: quit  s/S: sort column  r: reverse  /: filter  esc: clear filter  arrows/pgup/pgdn: scroll"
+
+    def __init__(self, stdscr: curses.window):
+        self.stdscr = stdscr
+        self.sort_column: int | None = None
+        self.reverse = False
+        self.filter = ""
+        self.scroll = 0
+        self._drawn: list[str] = []
+        # (latest data, view settings, formatted lines), holding on to the data so that it's compared by identity
+        self._table_cache: tuple[tuple, tuple, list[str]] | None = None
+
+    def table_lines(self, collector: UsageCollector) -> list[str]:
+        latest = collector.latest
+        if latest is None:
+            return ["Collecting usage..."]
+        # only re-format the table when the data or the view settings changed, not on every UI tick
+        view = (self.sort_column, self.reverse, self.filter)
+        if self._table_cache is not None and self._table_cache[0] is latest and self._table_cache[1] == view:
+            return self._table_cache[2]
+        timestamp, rows = latest
+        if self.filter:
+            rows = [r for r in rows if any(self.filter.lower() in cell.lower() for cell in r)]
+        if self.sort_column is not None:
+            rows = sorted(rows, key=lambda r: usage_sort_key(r[self.sort_column]), reverse=self.reverse)
+        lines = format_usage(timestamp, rows).split("\n")
+        self._table_cache = (latest, view, lines)
+        return lines
+
+    def status_line(self, collector: UsageCollector) -> str:
+        status = []
+        if collector.collecting:
+            status.append("collecting...")
+        if self.sort_column is not None:
+            status.append(f"sort: {USAGE_HEADERS[self.sort_column]}{' (desc)' if self.reverse else ''}")
+        if self.filter:
+            status.append(f"filter: {self.filter}")
+        status.append(self.HELP)
+        return " | ".join(status)
+
+    def draw(self, collector: UsageCollector):
+        max_y, max_x = self.stdscr.getmaxyx()
+        lines = self.table_lines(collector)
+        body_height = max(max_y - 1, 0)
+        self.scroll = max(0, min(self.scroll, len(lines) - body_height))
+        screen = [line[:max_x - 1] for line in lines[self.scroll:self.scroll + body_height]]
+        screen += [""] * (body_height - len(screen))
+        screen.append(self.status_line(collector)[:max_x - 1])
+        for i, line in enumerate(screen):
+            if i < len(self._drawn) and self._drawn[i] == line:
+                continue
+            self.stdscr.move(i, 0)
+            self.stdscr.clrtoeol()
+            self.stdscr.addstr(i, 0, line, curses.A_REVERSE if i == len(screen) - 1 else curses.A_NORMAL)
+        self._drawn = screen
+        self.stdscr.noutrefresh()
+        curses.doupdate()
+
+    def prompt_filter(self):
+        max_y, max_x = self.stdscr.getmaxyx()
+        self.stdscr.move(max_y - 1, 0)
+        self.stdscr.clrtoeol()
+        self.stdscr.addstr(max_y - 1, 0, "filter: ")
+        curses.echo()
+        curses.curs_set(1)
+        self.stdscr.timeout(-1)
+        try:
+            self.filter = self.stdscr.getstr(max_y - 1, len("filter: "), max(max_x - 10, 1)).decode(errors="replace").strip()
+        finally:
+            curses.noecho()
+            curses.curs_set(0)
+            self.stdscr.timeout(UI_TICK_MS)
+        self.scroll = 0
+        self._drawn = []
+
+    def handle_key(self, key: int) -> bool:
+        """
+        Update the view for a keypress, returning False if the user asked to quit.
+        """
+        page = max(self.stdscr.getmaxyx()[0] - 2, 1)
+        if key in (ord("q"), ord("Q")):
+            return False
+        elif key == ord("s"):
+            self.sort_column = 0 if self.sort_column is None else (self.sort_column + 1) % len(USAGE_HEADERS)
+        elif key == ord("S"):
+            self.sort_column = len(USAGE_HEADERS) - 1 if self.sort_column is None else (self.sort_column - 1) % len(USAGE_HEADERS)
+        elif key == ord("r"):
+            self.reverse = not self.reverse
+        elif key == ord("/"):
+            self.prompt_filter()
+        elif key == 27:  # escape
+            self.filter = ""
+        elif key in (curses.KEY_DOWN, ord("j")):
+            self.scroll += 1
+        elif key in (curses.KEY_UP, ord("k")):
+            self.scroll = max(self.scroll - 1, 0)
+        elif key == curses.KEY_NPAGE:
+            self.scroll += page
+        elif key == curses.KEY_PPAGE:
+            self.scroll = max(self.scroll - page, 0)
+        elif key == curses.KEY_HOME:
+            self.scroll = 0
+        elif key == curses.KEY_RESIZE:
+            self._drawn = []
+            self.stdscr.clear()
+        return True
+
+
+def print_usage_ndjson(args):
+    """
+    Print one JSON record per job for every new sample, until none of the experiments are running anymore.
+    """
+    last_updated: dict[str, float] = {}
+    with closing(sample_generator(args.stream, args.interval, args.host_timeout, args.discovery_interval, args.record, args.max_hosts)) as gen:
+        while True:
+            loop_start = time.perf_counter()
+            experiments, samples = next(gen)
+            if len(experiments) == 0:
+                return
+            for job, node in experiments:
+                sample = samples.get(node.hostname)
+                # hosts that haven't reported since the last round would just repeat their previous record
+                if sample is None or last_updated.get(job.id) == sample.updated or (usage := parse_job_usage(job, sample)) is None:
+                    continue
+                last_updated[job.id] = sample.updated
+                print_ndjson({"time": sample.updated, "job_id": job.id, "hostname": node.hostname, "stale": sample.stale, **usage})
+            if args.once:
+                return
+            sleep_time = args.interval - (time.perf_counter() - loop_start)
+            if sleep_time > 0:
+                time.sleep(sleep_time)
 
 
 def monitor(args, _):
+    if args.serve is not None:
+        from beaker_util.exporter import serve
+        serve(args)
+        return
+
+    if args.format == "ndjson":
+        try:
+            print_usage_ndjson(args)
+        except KeyboardInterrupt:
+            pass
+        return
+
     if args.once:
         try:
-            with closing(usage_generator()) as gen:
-                print(next(gen))
+            with closing(usage_generator(args.stream, args.interval, args.host_timeout, args.discovery_interval, args.record, args.max_hosts)) as gen:
+                print(format_usage(*next(gen)))
         except StopIteration:
             print("No running experiments detected.")
         return
 
-    exited_by_self = False
+    collector = UsageCollector(args).start()
 
     def monitor_curses(stdscr: curses.window):
         curses.curs_set(0)
         curses.start_color()
         curses.use_default_colors()
+        curses.set_escdelay(25)
+        stdscr.timeout(UI_TICK_MS)
 
-        with closing(usage_generator()) as gen:
-            try:
-                while True:
-                    loop_start = time.perf_counter()
-                    usage_data = next(gen)
-                    stdscr.clear()
-                    max_y, max_x = stdscr.getmaxyx()
-                    lines = usage_data.split('\n')
-                    for i, line in enumerate(lines):
-                        if i < max_y:
-                            stdscr.addstr(i, 0, line[:max_x])
-                    stdscr.refresh()
-                    loop_end = time.perf_counter()
-
-                    sleep_time = args.interval - (loop_end - loop_start)
-                    if sleep_time > 0:
-                        time.sleep(sleep_time)
-            except KeyboardInterrupt:
-                pass
-            except StopIteration:
-                nonlocal exited_by_self
-                exited_by_self = True
-            finally:
-                curses.curs_set(1)
-
-    curses.wrapper(monitor_curses)
-    if exited_by_self:
+        view = UsageView(stdscr)
+        try:
+            while not collector.finished and collector.error is None:
+                view.draw(collector)
+                # wake up on keypresses, or periodically to pick up newly collected data
+                key = stdscr.getch()
+                if key != -1 and not view.handle_key(key):
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            curses.curs_set(1)
+
+    try:
+        curses.wrapper(monitor_curses)
+    finally:
+        # give the collectors a chance to shut down their connections cleanly
+        collector.close(args.host_timeout)
+    if collector.error is not None:
+        raise collector.error
+    if collector.finished:
         print("No more running experiments detected, they may have finished.")
@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import math
+import os
+import re
+import struct
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # only needed for annotations, so that `monitor summary` doesn't import beaker or fabric
+    from beaker import BeakerJob, BeakerNode
+
+    from beaker_util.collectors import HostSample
+
+
+# Files start with this magic, followed by fixed-size little-endian records (one per job per sample), so recordings
+# can be appended to cheaply while monitoring and memory-mapped as a numpy structured array when summarizing.
+RECORDING_MAGIC = b"BUMONREC1\n"
+RECORD_FIELDS = [
+    ("time", "d"),
+    ("job", "26s"),  # beaker ids are 26 character ULIDs
+    ("n_gpus", "H"),
+    ("gpu_util", "f"),  # mean over the job's GPUs, in percent
+    ("vram_used", "f"),  # summed over the job's GPUs, in MiB
+    ("vram_total", "f"),
+    ("cpu", "f"),  # in percent of one core
+    ("ram", "d"),  # in bytes, as are all the fields below
+    ("net_in", "d"),
+    ("net_out", "d"),
+    ("blk_read", "d"),
+    ("blk_write", "d"),
+]
+RECORD_STRUCT = struct.Struct("<" + "".join(fmt for _, fmt in RECORD_FIELDS))
+
+# GPU utilization (in percent) below which a sample counts as idle
+IDLE_GPU_UTIL = 5
+
+SIZE_UNITS = {
+    "b": 1,
+    "kb": 1e3, "mb": 1e6, "gb": 1e9, "tb": 1e12, "pb": 1e15,
+    "kib": 2 ** 10, "mib": 2 ** 20, "gib": 2 ** 30, "tib": 2 ** 40, "pib": 2 ** 50,
+}
+SIZE_RE = re.compile(r"^\s*([0-9.]+)\s*([a-zA-Z]*)\s*$")
+
+
+def parse_size(s: str) -> float:
+    """
+    Parse a human-readable size as printed by docker (e.g. "14.83GiB" or "3.57GB") into bytes, or NaN if malformed.
+    """
+    match = SIZE_RE.match(s)
+    if match is None or match.group(2).lower() not in SIZE_UNITS:
+        return math.nan
+    return float(match.group(1)) * SIZE_UNITS[match.group(2).lower()]
+
+
+def parse_number(s: str) -> float:
+    """
+    Parse a number with an optional unit suffix (e.g. "542.51%", "81559 MiB", "0 %"), or NaN if malformed (e.g. "[N/A]").
+    """
+    match = re.match(r"^\s*([0-9.]+)", s)
+    return float(match.group(1)) if match is not None else math.nan
+
+
+def parse_pair(s: str, parse=parse_size) -> tuple[float, float]:
+    """Parse a docker "a / b" pair such as "3.57GB / 3.59MB"."""
+    a, _, b = s.partition("/")
+    return parse(a), parse(b)
+
+
+def parse_job_usage(job: BeakerJob, sample: HostSample) -> dict | None:
+    """
+    Parse the raw nvidia-smi and docker stats of a job into numbers (sizes in bytes), or None if its container isn't in the sample.
+    """
+    docker_row = sample.containers.get(f"execution-{job.id}".lower())
+    if docker_row is None:
+        return None
+    gpus = []
+    if job.assignment_details.HasField("resource_assignment"):
+        for gpu in job.assignment_details.resource_assignment.gpus:
+            if (row := sample.gpus.get(gpu)) is None:
+                continue
+            gpus.append({
+                "uuid": gpu,
+                "name": row["name"],
+                "utilization_percent": parse_number(row["utilization.gpu [%]"]),
+                "memory_used_bytes": parse_size(row["memory.used [MiB]"]),
+                "memory_total_bytes": parse_size(row["memory.total [MiB]"]),
+            })
+    net_in, net_out = parse_pair(docker_row["NetIO"])
+    blk_read, blk_write = parse_pair(docker_row["BlockIO"])
+    return {
+        "cpu_percent": parse_number(docker_row["CPUPerc"]),
+        "memory_bytes": parse_pair(docker_row["MemUsage"])[0],
+        "network_receive_bytes": net_in,
+        "network_transmit_bytes": net_out,
+        "block_read_bytes": blk_read,
+        "block_write_bytes": blk_write,
+        "gpus": gpus,
+    }
+
+
+class Recorder:
+    """
+    Appends one numeric record per running job to a recording file each time new samples arrive.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._last_updated: dict[str, float] = {}
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                f.write(RECORDING_MAGIC)
+        else:
+            with open(path, "r+b") as f:
+                if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+                    raise ValueError(f"{path} exists and is not a beakerutil monitor recording!")
+                # drop a record left truncated by a crash, otherwise every record appended after it would be misaligned
+                n_records = (os.path.getsize(path) - len(RECORDING_MAGIC)) // RECORD_STRUCT.size
+                f.truncate(len(RECORDING_MAGIC) + n_records * RECORD_STRUCT.size)
+
+    def record(self, experiments: list[tuple[BeakerJob, BeakerNode]], samples: dict[str, HostSample]):
+        records = []
+        for job, node in experiments:
+            sample = samples.get(node.hostname)
+            # don't record the same sample twice, e.g. a stale host or a stream that hasn't refreshed since the last tick
+            if sample is None or sample.stale or self._last_updated.get(job.id) == sample.updated:
+                continue
+            usage = parse_job_usage(job, sample)
+            if usage is None:
+                continue
+            self._last_updated[job.id] = sample.updated
+
+            gpus = usage["gpus"]
+            records.append(RECORD_STRUCT.pack(
+                sample.updated,
+                job.id.encode("ascii")[:26],
+                len(gpus),
+                sum(g["utilization_percent"] for g in gpus) / len(gpus) if gpus else math.nan,
+                sum(g["memory_used_bytes"] for g in gpus) / 2 ** 20 if gpus else math.nan,
+                sum(g["memory_total_bytes"] for g in gpus) / 2 ** 20 if gpus else math.nan,
+                usage["cpu_percent"],
+                usage["memory_bytes"],
+                usage["network_receive_bytes"], usage["network_transmit_bytes"],
+                usage["block_read_bytes"], usage["block_write_bytes"],
+            ))
+        if records:
+            # a single append per tick, so a crash can at worst leave a truncated trailing record
+            with open(self.path, "ab") as f:
+                f.write(b"".join(records))
+
+
+def load_recording(path: str):
+    import numpy as np
+
+    dtype = np.dtype([(name, "<" + ("S26" if fmt == "26s" else fmt)) for name, fmt in RECORD_FIELDS])
+    assert dtype.itemsize == RECORD_STRUCT.size
+    with open(path, "rb") as f:
+        if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f"{path} is not a beakerutil monitor recording!")
+    n_records = (os.path.getsize(path) - len(RECORDING_MAGIC)) // dtype.itemsize
+    if n_records == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=len(RECORDING_MAGIC), shape=(n_records,))
+
+
+def summarize_recording(records) -> list[dict]:
+    """
+    Compute per-job usage statistics over a recording, vectorized over all records at once.
+    """
+    import numpy as np
+
+    if len(records) == 0:
+        return []
+    jobs, inverse = np.unique(records["job"], return_inverse=True)
+    n_jobs = len(jobs)
+    counts = np.bincount(inverse, minlength=n_jobs)
+
+    def nanmean(values):
+        valid = ~np.isnan(values)
+        sums = np.bincount(inverse, weights=np.where(valid, values, 0), minlength=n_jobs)
+        n_valid = np.bincount(inverse, weights=valid, minlength=n_jobs)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(n_valid > 0, sums / n_valid, np.nan)
+
+    def percentile(values, q):
+        # sort by job, then by value (NaNs last), and index into each job's run of records
+        order = np.lexsort((values, inverse))
+        sorted_values = values[order]
+        n_valid = np.bincount(inverse, weights=~np.isnan(values), minlength=n_jobs).astype(int)
+        starts = np.cumsum(counts) - counts
+        idx = starts + np.maximum(np.ceil(q * n_valid).astype(int) - 1, 0)
+        return np.where(n_valid > 0, sorted_values[idx], np.nan)
+
+    gpu_util = records["gpu_util"].astype(np.float64)
+    first = np.full(n_jobs, np.inf)
+    last = np.full(n_jobs, -np.inf)
+    np.minimum.at(first, inverse, records["time"])
+    np.maximum.at(last, inverse, records["time"])
+    n_gpus = np.zeros(n_jobs, dtype=np.int64)
+    np.maximum.at(n_gpus, inverse, records["n_gpus"])
+    max_ram = np.zeros(n_jobs)
+    np.fmax.at(max_ram, inverse, records["ram"])
+    mean_gpu_util = nanmean(gpu_util)
+    p95_gpu_util = percentile(gpu_util, 0.95)
+    idle_fraction = nanmean(np.where(np.isnan(gpu_util), np.nan, (gpu_util < IDLE_GPU_UTIL).astype(np.float64)))
+    mean_cpu = nanmean(records["cpu"].astype(np.float64))
+
+    def decode_job(job: bytes) -> str:
+        try:
+            return job.decode("ascii")
+        except UnicodeDecodeError:
+            raise ValueError(f"corrupt job id {bytes(job)!r}") from None
+
+    return [
+        {
+            "job": decode_job(job),
+            "samples": int(counts[i]),
+            "start": float(first[i]),
+            "duration": float(last[i] - first[i]),
+            "gpus": int(n_gpus[i]),
+            "mean_gpu_util": float(mean_gpu_util[i]),
+            "p95_gpu_util": float(p95_gpu_util[i]),
+            "idle_fraction": float(idle_fraction[i]),
+            "mean_cpu": float(mean_cpu[i]),
+            "max_ram": float(max_ram[i]),
+        }
+        for i, job in enumerate(jobs)
+    ]
+
+
+def summary(args, _):
+    from datetime import datetime, timedelta
+    from tabulate import tabulate
+
+    try:
+        records = load_recording(args.recording)
+        rows = [r for r in summarize_recording(records) if not args.job or re.match(args.job, r["job"])]
+    except (OSError, ValueError) as e:
+        print(f"Could not read recording: {e}")
+        exit(1)
+    if len(rows) == 0:
+        print("No samples recorded.")
+        return
+    # jobs wasting the most reserved GPU time first
+    rows.sort(key=lambda r: (r["gpus"] == 0, r["mean_gpu_util"] if not math.isnan(r["mean_gpu_util"]) else math.inf))
+
+    def fmt(x, spec):
+        return "" if math.isnan(x) else format(x, spec)
+
+    table = [[
+        r["job"],
+        datetime.fromtimestamp(r["start"]).strftime("%m/%d/%Y %H:%M:%S"),
+        str(timedelta(seconds=round(r["duration"]))),
+        r["samples"],
+        r["gpus"],
+        fmt(r["mean_gpu_util"], ".1f"),
+        fmt(r["p95_gpu_util"], ".1f"),
+        fmt(100 * r["idle_fraction"], ".0f"),
+        fmt(r["mean_cpu"], ".1f"),
+        fmt(r["max_ram"] / 2 ** 30, ".2f"),
+    ] for r in rows]
+    headers = ["Job", "Start", "Duration", "Samples", "GPUs", "Mean GPU %", "p95 GPU %", "Idle %", "Mean CPU %", "Max RAM (GiB)"]
+    print(tabulate(table, headers=headers))
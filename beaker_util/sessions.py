@@ -0,0 +1,321 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import os
+import re
+import sys
+from typing import Any, Callable, Iterable, TypeVar
+
+from beaker import Beaker, BeakerJob, BeakerNode, BeakerWorkload, BeakerWorkloadStatus
+
+from beaker_util.cache import MetadataCache
+from beaker_util.completion import save_sessions
+from beaker_util.daemon import get_daemon_sessions, request_daemon, use_daemon
+from beaker_util.live import LiveBlock
+from beaker_util.tracing import report_trace
+from beaker_util.utils import SessionSnapshot, inject_beaker, iter_sessions, make_session_snapshot, print_ndjson
+
+# Workloads cancelled per API call when stopping several sessions
+CANCEL_BATCH_SIZE = 10
+
+T = TypeVar("T")
+
+
+class SelectionError(Exception):
+    """The selectors given to attach or stop match no session."""
+
+
+def session_record(job: BeakerJob, node: BeakerNode | None, is_interactive: bool) -> dict:
+    resources = job.assignment_details.resource_assignment if job.assignment_details.HasField("resource_assignment") else None
+    return {
+        "id": job.id,
+        "name": job.name or None,
+        "interactive": is_interactive,
+        "status": BeakerWorkloadStatus(job.status.status).name,
+        "hostname": node.hostname if node is not None else None,
+        "gpus": len(resources.gpus) if resources is not None else 0,
+        "memory_bytes": resources.memory_bytes if resources is not None else None,
+        "cpu_count": resources.cpu_count if resources is not None else None,
+        "created": datetime.fromtimestamp(job.status.created.seconds + job.status.created.nanos / 1e9, timezone.utc).isoformat(),
+    }
+
+
+def format_sessions(snapshot: SessionSnapshot) -> list[str]:
+    if len(snapshot.jobs) == 0:
+        return [f"No sessions found for author {snapshot.user_name}."]
+
+    lines = []
+    idx = 0
+
+    def format_group(title, s: list[tuple[BeakerJob, BeakerNode | None]]):
+        nonlocal idx
+        if len(s) == 0:
+            return
+        lines.append(title)
+        for j, n in s:
+            name_str = f" (name={j.name})" if j.name else ""
+            reserved_str = "with no resources requested"
+            if j.assignment_details.HasField("resource_assignment"):
+                reserved_str = f"using: [{len(j.assignment_details.resource_assignment.gpus)} GPU(s)"
+                if j.assignment_details.resource_assignment.memory_bytes:
+                    reserved_str += f", {j.assignment_details.resource_assignment.memory_bytes} of memory"
+                if j.assignment_details.resource_assignment.cpu_count:
+                    reserved_str += f", {j.assignment_details.resource_assignment.cpu_count:g} CPU(s)"
+                reserved_str += "]"
+
+            job_created = datetime.fromtimestamp(j.status.created.seconds + j.status.created.nanos / 1e9)
+            now = datetime.now(job_created.tzinfo)
+            job_duration = now - job_created
+            days = job_duration.days
+            hours = job_duration.seconds // 3600
+            minutes = (job_duration.seconds % 3600) // 60
+            if days > 0:
+                duration_str = f"{days} days"
+            elif hours > 0:
+                duration_str = f"{hours} hours"
+            elif minutes > 0:
+                duration_str = f"{minutes} minute{'' if minutes == 1 else 's'}"
+            else:
+                duration_str = "less than a minute"
+
+            node_str = f"on node {n.hostname}" if n is not None else "waiting for assignment"
+            lines.append(f"\t{idx}: Session {j.id}{name_str} {node_str} {reserved_str}, status={BeakerWorkloadStatus(j.status.status).name}, running for {duration_str}")
+            idx += 1
+
+    format_group("Interactive sessions:", snapshot.interactive)
+    format_group("Noninteractive sessions:", snapshot.noninteractive)
+    return lines
+
+
+def remember_sessions(snapshot: SessionSnapshot, exclude: set[str] = frozenset()):
+    """
+    Save the sessions for shell completion, without the given job ids (e.g. ones that were just stopped).
+    """
+    save_sessions([
+        {
+            "id": j.id,
+            "name": j.name,
+            "interactive": snapshot.is_job_interactive(j),
+            "hostname": n.hostname if n is not None else None,
+            "status": BeakerWorkloadStatus(j.status.status).name,
+        }
+        for j, n in snapshot.indexed if j.id not in exclude
+    ])
+
+
+def get_sessions(beaker: Beaker, args) -> tuple[str, Iterable[tuple[BeakerWorkload, BeakerJob, BeakerNode | None]]]:
+    """
+    The user name and sessions, from the daemon if one is running, and otherwise resolved through the API as they come in.
+    """
+    if use_daemon(args) and (daemon_sessions := get_daemon_sessions()) is not None:
+        return daemon_sessions
+    user_name = beaker.user_name
+    return user_name, iter_sessions(beaker, user_name, cache=MetadataCache.from_args(args))
+
+
+def select_sessions(beaker: Beaker, args, select: Callable[[SessionSnapshot, Any], T]) -> tuple[SessionSnapshot, T]:
+    """
+    Load the sessions and apply `select` to them, exiting with its error if it fails. A daemon's snapshot can miss
+    sessions started since its last refresh, so a selection that fails on it is retried with sessions from the API.
+    """
+    if use_daemon(args) and (daemon_sessions := get_daemon_sessions()) is not None:
+        snapshot = make_session_snapshot(beaker, *daemon_sessions)
+        try:
+            selected = select(snapshot, args)
+            remember_sessions(snapshot)
+            return snapshot, selected
+        except SelectionError:
+            pass
+    user_name = beaker.user_name
+    snapshot = make_session_snapshot(beaker, user_name, iter_sessions(beaker, user_name, cache=MetadataCache.from_args(args)))
+    remember_sessions(snapshot)
+    try:
+        return snapshot, select(snapshot, args)
+    except SelectionError as e:
+        print(e)
+        exit(1)
+
+
+@inject_beaker
+def list_sessions(beaker: Beaker, args, _):
+    user_name, session_iter = get_sessions(beaker, args)
+    sessions = []
+    if args.format == "ndjson":
+        # records are written in completion order, use the id (not the `list` index) to refer to sessions
+        for session in session_iter:
+            workload, job, node = session
+            sessions.append(session)
+            print_ndjson(session_record(job, node, beaker.workload.is_environment(workload)))
+        remember_sessions(make_session_snapshot(beaker, user_name, sessions))
+        return
+
+    # on a terminal, show sessions as they resolve (re-sorted every time), the indices are final once done
+    live = LiveBlock()
+    for session in session_iter:
+        sessions.append(session)
+        live.update(lambda: format_sessions(make_session_snapshot(beaker, user_name, sessions)) + [f"Resolving sessions... ({len(sessions)} so far)"])
+    snapshot = make_session_snapshot(beaker, user_name, sessions)
+    live.finish(format_sessions(snapshot))
+    remember_sessions(snapshot)
+
+
+def select_session(snapshot: SessionSnapshot, args) -> BeakerJob:
+    """
+    The interactive session selected by the arguments of `attach`.
+    """
+    session_jobs = [j for j, _ in snapshot.interactive]
+
+    assert isinstance(args.session_idx, (type(None), int))
+    if len(session_jobs) == 0:
+        raise SelectionError(f"No sessions found for author {snapshot.user_name}.")
+    elif args.session_idx is not None:
+        if args.session_idx < 0 or args.session_idx >= len(session_jobs):
+            raise SelectionError(f"Invalid session index {args.session_idx}!")
+        return session_jobs[args.session_idx]
+    elif args.name is not None:
+        session = next((s for s in session_jobs if s.name == args.name), None)
+        if session is None:
+            raise SelectionError(f"No session found with name {args.name}!")
+        return session
+    elif args.id is not None:
+        session = next((s for s in session_jobs if s.id == args.id), None)
+        if session is None:
+            raise SelectionError(f"No session found with id {args.id}!")
+        return session
+    elif len(session_jobs) == 1:
+        return session_jobs[0]
+    raise SelectionError("No session specified and no unique session found!")
+
+
+@inject_beaker
+def attach(beaker: Beaker, args, _):
+    snapshot, session = select_sessions(beaker, args, select_session)
+    node = snapshot.node_of(session)
+    node_str = f"on node {node.hostname}" if node is not None else "waiting for assignment"
+    print(f"Attempting to attach to session {session.name or session.id} {node_str}...")
+    report_trace()
+    os.execlp("beaker", *f"beaker session attach --remote {session.id}".split())
+
+
+def select_jobs(snapshot: SessionSnapshot, args) -> list[BeakerJob]:
+    """
+    The sessions selected by the arguments of `stop`, in `list` order. Raises a SelectionError if a selector matches nothing.
+    """
+    jobs = [j for j, _ in snapshot.indexed]
+    if len(jobs) == 0:
+        raise SelectionError(f"No workloads found for author {snapshot.user_name}.")
+    explicit = len(args.session_idx) > 0 or args.name is not None or args.id is not None or args.match is not None
+    if not (explicit or args.all or args.queued or args.idle):
+        if len(jobs) != 1:
+            raise SelectionError("No session specified and no unique session found!")
+        return jobs
+
+    selected = set()
+    for idx in args.session_idx:
+        if idx < 0 or idx >= len(jobs):
+            raise SelectionError(f"Invalid workload index {idx}!")
+        selected.add(jobs[idx].id)
+    for value, field, description in [(args.name, "name", "name"), (args.id, "id", "id")]:
+        if value is not None:
+            matches = [j.id for j in jobs if getattr(j, field) == value]
+            if len(matches) == 0:
+                raise SelectionError(f"No job found with {description} {value}!")
+            selected.update(matches)
+    if args.match is not None:
+        try:
+            pattern = re.compile(args.match)
+        except re.error as e:
+            print(f"Invalid regex {args.match}: {e}")
+            exit(1)
+        matches = [j.id for j in jobs if pattern.match(j.name) or pattern.match(j.id)]
+        if len(matches) == 0:
+            raise SelectionError(f"No job found with a name or id matching {args.match}!")
+        selected.update(matches)
+    if not explicit:
+        # --all, or just --queued/--idle, which narrow down every session
+        selected = {j.id for j in jobs}
+
+    jobs = [
+        j for j in jobs
+        if j.id in selected
+        and (not args.queued or snapshot.node_of(j) is None)
+        and (not args.idle or j.status.HasField("idle_since"))
+    ]
+    if len(jobs) == 0:
+        raise SelectionError("No sessions match the given selectors.")
+    return jobs
+
+
+def cancel_workloads(beaker: Beaker, workloads: list[BeakerWorkload], n_workers: int) -> list[Exception | None]:
+    """
+    Cancel the workloads in concurrent batches, returning the error (or None) for each.
+    A batch that fails is retried one workload at a time, so that one bad workload doesn't fail the others.
+    """
+    def cancel_batch(batch: list[BeakerWorkload]) -> list[Exception | None]:
+        try:
+            beaker.workload.cancel(*batch)
+            return [None] * len(batch)
+        except Exception:
+            if len(batch) == 1:
+                raise
+        errors = []
+        for workload in batch:
+            try:
+                beaker.workload.cancel(workload)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+    def cancel_batch_safe(batch: list[BeakerWorkload]) -> list[Exception | None]:
+        try:
+            return cancel_batch(batch)
+        except Exception as e:
+            return [e]
+
+    batches = [workloads[i:i + CANCEL_BATCH_SIZE] for i in range(0, len(workloads), CANCEL_BATCH_SIZE)]
+    with ThreadPoolExecutor(max(1, min(n_workers, len(batches)))) as executor:
+        return [e for errors in executor.map(cancel_batch_safe, batches) for e in errors]
+
+
+def describe_job(snapshot: SessionSnapshot, job: BeakerJob) -> str:
+    node = snapshot.node_of(job)
+    node_str = f"on node {node.hostname}" if node is not None else "waiting for assignment"
+    kind = "interactive" if snapshot.is_job_interactive(job) else "noninteractive"
+    return f"{kind} session {job.id}{f' (name={job.name})' if job.name else ''} {node_str}, status={BeakerWorkloadStatus(job.status.status).name}"
+
+
+@inject_beaker
+def stop(beaker: Beaker, args, _):
+    if args.all and (len(args.session_idx) > 0 or args.name is not None or args.id is not None or args.match is not None):
+        # rather than guess whether all sessions or only the selected ones were meant
+        print("--all can't be combined with session indices, --name, --id or --match!")
+        exit(1)
+    snapshot, jobs = select_sessions(beaker, args, select_jobs)
+    indices = {j.id: i for i, (j, _) in enumerate(snapshot.indexed)}
+    print(f"{'Would stop' if args.dry_run else 'Stopping'} {len(jobs)} session(s):")
+    for job in jobs:
+        print(f"\t{indices[job.id]}: {describe_job(snapshot, job)}")
+    if args.dry_run:
+        return
+    # selectors can match more than meant, so confirm before cancelling several sessions at once
+    if len(jobs) > 1 and not args.yes:
+        if not sys.stdin.isatty():
+            print("Refusing to stop several sessions without confirmation, pass --yes to do so non-interactively.")
+            exit(1)
+        if input("Continue? [y/N] ").strip().lower() not in ("y", "yes"):
+            print("Aborted.")
+            exit(1)
+
+    errors = cancel_workloads(beaker, [snapshot.workload_of(j) for j in jobs], args.n_workers)
+    for job, error in zip(jobs, errors):
+        if error is None:
+            # so that a running daemon stops listing the session right away
+            request_daemon({"forget_job": job.id})
+        print(f"\t{job.name or job.id}: {'stopped' if error is None else f'failed ({error})'}")
+    # the stopped sessions are gone, and the indices of the others shift up accordingly
+    remember_sessions(snapshot, exclude={j.id for j, e in zip(jobs, errors) if e is None})
+    n_failed = sum(e is not None for e in errors)
+    if len(jobs) > 1:
+        print(f"Stopped {len(jobs) - n_failed} of {len(jobs)} session(s).")
+    if n_failed > 0:
+        exit(1)
@@ -0,0 +1,201 @@
+import atexit
+from collections import defaultdict
+from functools import cached_property
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Iterator
+
+# Set to "1" to print a summary of the Beaker API calls made by a command to stderr when it exits,
+# or to a path to additionally write them there as a Chrome trace (viewable in chrome://tracing or Perfetto).
+PROFILE_ENV = "BEAKERUTIL_PROFILE"
+
+# Client attributes whose method calls are traced
+TRACED_SERVICES = (
+    "cluster", "dataset", "experiment", "group", "image", "job", "node",
+    "organization", "queue", "secret", "user", "workload", "workspace",
+)
+# Methods that don't talk to the API
+UNTRACED_METHODS = ("is_environment", "is_experiment", "url")
+
+
+class RpcTracer:
+    """
+    Thread-safe record of every traced call: its name, when it started, how long it took, and on which thread.
+    """
+
+    def __init__(self, output: str | None = None):
+        self.output = output
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._events: list[tuple[str, float, float, int]] = []
+        self._thread_names: dict[int, str] = {}
+        self._reported = False
+
+    def record(self, name: str, start: float, duration: float):
+        thread = threading.current_thread()
+        with self._lock:
+            self._events.append((name, start - self.start, duration, thread.ident))
+            self._thread_names[thread.ident] = thread.name
+
+    def summary(self) -> str:
+        from tabulate import tabulate
+
+        with self._lock:
+            events = list(self._events)
+        calls: dict[str, list[tuple[float, int]]] = defaultdict(list)
+        for name, _, duration, thread in events:
+            calls[name].append((duration, thread))
+        rows = [
+            [name, len(c), sum(d for d, _ in c), 1000 * sum(d for d, _ in c) / len(c), 1000 * max(d for d, _ in c), len(set(t for _, t in c))]
+            for name, c in calls.items()
+        ]
+        rows.sort(key=lambda r: -r[2])
+        wall_time = time.perf_counter() - self.start
+        table = tabulate(rows, headers=["Call", "Count", "Total (s)", "Mean (ms)", "Max (ms)", "Threads"], floatfmt=".3f")
+        return f"{len(events)} Beaker API call(s) in {wall_time:.3f}s:\n{table}"
+
+    def chrome_trace(self) -> dict[str, Any]:
+        with self._lock:
+            events = list(self._events)
+            thread_names = dict(self._thread_names)
+        pid = os.getpid()
+        trace_events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in thread_names.items()
+        ]
+        trace_events += [
+            {"name": name, "cat": "rpc", "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": pid, "tid": tid}
+            for name, start, duration, tid in events
+        ]
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def report(self):
+        """
+        Print the summary and write the trace, once. Called at exit, or before a command replaces the process.
+        """
+        if self._reported:
+            return
+        self._reported = True
+        print(self.summary(), file=sys.stderr)
+        if self.output is not None:
+            with open(self.output, "w") as f:
+                json.dump(self.chrome_trace(), f)
+            print(f"Wrote Chrome trace to {self.output}", file=sys.stderr)
+
+
+_tracer: RpcTracer | None = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> RpcTracer | None:
+    """
+    The process-wide tracer, or None if profiling isn't enabled.
+    """
+    global _tracer
+    value = os.environ.get(PROFILE_ENV, "")
+    if value in ("", "0"):
+        return None
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = RpcTracer(output=None if value == "1" else value)
+            atexit.register(_tracer.report)
+        return _tracer
+
+
+def report_trace():
+    if _tracer is not None:
+        _tracer.report()
+
+
+class _TracedService:
+    def __init__(self, service_name: str, service, tracer: RpcTracer):
+        self._service_name = service_name
+        self._service = service
+        self._tracer = tracer
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._service, name)
+        if name.startswith("_") or name in UNTRACED_METHODS or not callable(attr):
+            return attr
+        call_name = f"{self._service_name}.{name}"
+        tracer = self._tracer
+
+        def traced(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except BaseException:
+                tracer.record(call_name, start, time.perf_counter() - start)
+                raise
+            if isinstance(result, Iterator):
+                # list methods page lazily, so the calls happen while the result is consumed
+                return _traced_iterator(result, call_name, start, time.perf_counter() - start, tracer)
+            tracer.record(call_name, start, time.perf_counter() - start)
+            return result
+
+        return traced
+
+
+def _traced_iterator(it: Iterator, call_name: str, start: float, elapsed: float, tracer: RpcTracer):
+    try:
+        while True:
+            step_start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - step_start
+            yield item
+    finally:
+        # the time spent inside the iterator, not the time the caller took consuming it
+        tracer.record(call_name, start, elapsed)
+
+
+class TracedBeaker:
+    """
+    Wraps a Beaker client so that calls to its services are recorded by the tracer.
+    """
+
+    def __init__(self, beaker, tracer: RpcTracer):
+        self._beaker = beaker
+        self._tracer = tracer
+        self._services: dict[str, _TracedService] = {}
+
+    def __getattr__(self, name: str):
+        if name in TRACED_SERVICES:
+            if name not in self._services:
+                self._services[name] = _TracedService(name, getattr(self._beaker, name), self._tracer)
+            return self._services[name]
+        return getattr(self._beaker, name)
+
+    # these make calls through the unwrapped services, so go through the traced ones instead,
+    # unless the (pooled) client already has them cached
+    @cached_property
+    def user_name(self) -> str:
+        if "user_name" not in vars(self._beaker):
+            vars(self._beaker)["user_name"] = self.user.get().name
+        return self._beaker.user_name
+
+    @cached_property
+    def org_name(self) -> str:
+        if "org_name" not in vars(self._beaker):
+            vars(self._beaker)["org_name"] = self.organization.get().name
+        return self._beaker.org_name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return self._beaker.__exit__(*exc)
+
+
+def trace_client(beaker):
+    """
+    Wrap the client for tracing if profiling is enabled, otherwise return it as is.
+    """
+    tracer = get_tracer()
+    return beaker if tracer is None else TracedBeaker(beaker, tracer)
@@ -1,12 +1,25 @@
+import atexit
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from copy import deepcopy
-from functools import wraps
-from typing import Any
+from dataclasses import dataclass
+from functools import cached_property, wraps
+from types import MappingProxyType
+from typing import Any, Iterable, Iterator, Mapping
+import json
+import math
 import re
+import threading
 from functools import cmp_to_key
 
-from beaker import Beaker, BeakerJob, BeakerNode
+from beaker import Beaker, BeakerCluster, BeakerJob, BeakerNode, BeakerWorkload
+from beaker.config import Config
 import yaml
 
+from beaker_util.cache import NO_CACHE, MetadataCache
+from beaker_util.tracing import trace_client
+
 
 class ConfigDumper(yaml.SafeDumper):
     """
@@ -20,57 +33,315 @@ class ConfigDumper(yaml.SafeDumper):
             super().write_line_break()
 
 
+# Upper bound on the number of clients (and so gRPC channels) shared by all threads of the process
+MAX_POOLED_CLIENTS = 4
+
+
+class BeakerPool:
+    """
+    Process-wide pool of Beaker clients, all created from a config that is read once.
+    gRPC channels are thread-safe and multiplex concurrent calls, so clients are shared rather than leased exclusively:
+    each acquire gets the least busy client, and a new one is only created while every client is in use.
+    """
+
+    def __init__(self, max_size: int = MAX_POOLED_CLIENTS):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._config: Config | None = None
+        self._clients: list[Beaker] = []
+        self._users: list[int] = []
+
+    def _new_client(self) -> Beaker:
+        if self._config is None:
+            self._config = Config.from_env()
+        # only the first client needs to check for a newer beaker-py
+        client = Beaker(self._config, check_for_upgrades=len(self._clients) == 0)
+        # the channel is otherwise opened lazily, which isn't safe to race from several threads
+        client.service
+        return client
+
+    @contextmanager
+    def acquire(self) -> Iterator[Beaker]:
+        with self._lock:
+            i = min(range(len(self._clients)), key=self._users.__getitem__, default=None)
+            if i is None or (self._users[i] > 0 and len(self._clients) < self.max_size):
+                self._clients.append(self._new_client())
+                self._users.append(0)
+                i = len(self._clients) - 1
+            self._users[i] += 1
+        try:
+            yield self._clients[i]
+        finally:
+            with self._lock:
+                self._users[i] -= 1
+
+    def close(self):
+        with self._lock:
+            for client in self._clients:
+                client.close()
+            self._clients.clear()
+            self._users.clear()
+
+
+BEAKER_POOL = BeakerPool()
+atexit.register(BEAKER_POOL.close)
+
+
 def inject_beaker(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        with Beaker.from_env() as beaker:
-            return func(beaker, *args, **kwargs)
+        with BEAKER_POOL.acquire() as beaker:
+            return func(trace_client(beaker), *args, **kwargs)
     return wrapper
 
 
-def get_workloads_and_jobs(beaker: Beaker):
-    workloads = list(beaker.workload.list(author=beaker.user_name, finalized=False))
-    jobs = [beaker.workload.get_latest_job(w) for w in workloads]
-    workloads = [w for w, j in zip(workloads, jobs) if j is not None]
-    jobs = [j for j in jobs if j is not None]
-    return workloads, jobs
+# Upper bound on concurrent lookups when resolving jobs and nodes
+DEFAULT_N_WORKERS = 8
+
+
+def resolve_latest_jobs(beaker: Beaker, workloads: list[BeakerWorkload], n_workers: int = DEFAULT_N_WORKERS) -> list[BeakerJob | None]:
+    """
+    Fetch the latest job of every workload concurrently, preserving the order of `workloads`.
+    """
+    if len(workloads) == 0:
+        return []
+    with ThreadPoolExecutor(min(n_workers, len(workloads))) as executor:
+        return list(executor.map(beaker.workload.get_latest_job, workloads))
+
 
+def resolve_nodes(beaker: Beaker, jobs: Iterable[BeakerJob], n_workers: int = DEFAULT_N_WORKERS, cache: MetadataCache = NO_CACHE) -> dict[str, BeakerNode]:
+    """
+    Fetch the nodes the given jobs are scheduled on, mapped by node id. Each distinct node is fetched only once.
+    """
+    node_ids = sorted({j.assignment_details.node_id for j in jobs if j.assignment_details.node_id})
+    if len(node_ids) == 0:
+        return {}
+
+    def get_node(node_id: str):
+        return cache.get("node", node_id, BeakerNode, lambda: beaker.node.get(node_id))
+
+    with ThreadPoolExecutor(min(n_workers, len(node_ids))) as executor:
+        return dict(zip(node_ids, executor.map(get_node, node_ids)))
+
+
+@dataclass(frozen=True)
+class SessionSnapshot:
+    """
+    Immutable view of the current user's unfinalized workloads, their latest jobs, and the nodes they're on.
+    Built once per command so that every consumer sees the same sessions (and the same indices) without extra API calls.
+    """
+    user_name: str
+    workloads: tuple[BeakerWorkload, ...]
+    jobs: tuple[BeakerJob, ...]
+    is_interactive: tuple[bool, ...]
+    nodes: Mapping[str, BeakerNode]
+
+    def node_of(self, job: BeakerJob) -> BeakerNode | None:
+        return self.nodes.get(job.assignment_details.node_id) if job.assignment_details.node_id else None
+
+    def _sorted_sessions(self, interactive: bool) -> list[tuple[BeakerJob, BeakerNode | None]]:
+        def cmp(x1: tuple[BeakerJob, BeakerNode | None], x2: tuple[BeakerJob, BeakerNode | None]):
+            # group jobs by node and sort by ID within each group (queued jobs go last)
+            if x1[1] is None and x2[1] is not None:
+                return 1
+            elif x1[1] is not None and x2[1] is None:
+                return -1
+            elif x1[1] is None and x2[1] is None:
+                return -1 if x1[0].id < x2[0].id else 1
+            else:
+                return -1 if x1[1].hostname + x1[0].id < x2[1].hostname + x2[0].id else 1
+
+        sessions = [(j, self.node_of(j)) for j, i in zip(self.jobs, self.is_interactive) if i == interactive]
+        sessions.sort(key=cmp_to_key(cmp))
+        return sessions
+
+    @cached_property
+    def interactive(self) -> list[tuple[BeakerJob, BeakerNode | None]]:
+        return self._sorted_sessions(True)
+
+    @cached_property
+    def noninteractive(self) -> list[tuple[BeakerJob, BeakerNode | None]]:
+        return self._sorted_sessions(False)
+
+    @cached_property
+    def indexed(self) -> list[tuple[BeakerJob, BeakerNode | None]]:
+        """All sessions in the order (and with the indices) shown by `beakerutil list`."""
+        return self.interactive + self.noninteractive
+
+    def is_job_interactive(self, job: BeakerJob) -> bool:
+        return next(i for j, i in zip(self.jobs, self.is_interactive) if j.id == job.id)
+
+    def workload_of(self, job: BeakerJob) -> BeakerWorkload:
+        return next(w for w, j in zip(self.workloads, self.jobs) if j.id == job.id)
+
+
+class _OnceEach:
+    """
+    Thread-safe memoization of `func`, so that concurrent callers asking for the same key share a single call.
+    """
 
-def get_jobs_and_nodes(beaker: Beaker):
-    interactive_jobs: list[BeakerJob] = []
-    noninteractive_jobs: list[BeakerJob] = []
-    for workload in beaker.workload.list(author=beaker.user_name, finalized=False):
+    def __init__(self, func):
+        self._func = func
+        self._lock = threading.Lock()
+        self._futures: dict[Any, Future] = {}
+
+    def __call__(self, key):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+        if owner:
+            try:
+                future.set_result(self._func(key))
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+
+def iter_sessions(beaker: Beaker, user_name: str, n_workers: int = DEFAULT_N_WORKERS,
+                  cache: MetadataCache = NO_CACHE) -> Iterator[tuple[BeakerWorkload, BeakerJob, BeakerNode | None]]:
+    """
+    Yield (workload, latest job, node) for each of the user's unfinalized sessions as soon as it is resolved,
+    in completion order. Each distinct node is still fetched only once.
+    """
+    workloads = [
+        w for w in beaker.workload.list(author=user_name, finalized=False)
+        if beaker.workload.is_environment(w) or beaker.workload.is_experiment(w)
+    ]
+    if len(workloads) == 0:
+        return
+    get_node = _OnceEach(lambda node_id: cache.get("node", node_id, BeakerNode, lambda: beaker.node.get(node_id)))
+
+    def resolve(workload: BeakerWorkload):
         job = beaker.workload.get_latest_job(workload)
-        if job is not None:
-            if beaker.workload.is_environment(workload):
-                interactive_jobs.append(job)
-            elif beaker.workload.is_experiment(workload):
-                noninteractive_jobs.append(job)
-
-    def get_node(j: BeakerJob):
-        return beaker.node.get(j.assignment_details.node_id) if j.assignment_details.node_id else None
-
-    interactive = [(j, get_node(j)) for j in interactive_jobs]
-    noninteractive = [(j, get_node(j)) for j in noninteractive_jobs]
-
-    def cmp(x1: tuple[BeakerJob, BeakerNode | None], x2: tuple[BeakerJob, BeakerNode | None]):
-        # group jobs by node and sort by ID within each group (queued jobs go last)
-        if x1[1] is None and x2[1] is not None:
-            return 1
-        elif x1[1] is not None and x2[1] is None:
-            return -1
-        elif x1[1] is None and x2[1] is None:
-            return -1 if x1[0].id < x2[0].id else 1
-        else:
-            return -1 if x1[1].hostname + x1[0].id < x2[1].hostname + x2[0].id else 1
+        if job is None:
+            return None
+        return workload, job, get_node(job.assignment_details.node_id) if job.assignment_details.node_id else None
+
+    with ThreadPoolExecutor(min(n_workers, len(workloads))) as executor:
+        for future in as_completed([executor.submit(resolve, w) for w in workloads]):
+            if (session := future.result()) is not None:
+                yield session
+
+
+def make_session_snapshot(beaker: Beaker, user_name: str, sessions: Iterable[tuple[BeakerWorkload, BeakerJob, BeakerNode | None]]) -> SessionSnapshot:
+    sessions = list(sessions)
+    return SessionSnapshot(
+        user_name=user_name,
+        workloads=tuple(w for w, _, _ in sessions),
+        jobs=tuple(j for _, j, _ in sessions),
+        is_interactive=tuple(beaker.workload.is_environment(w) for w, _, _ in sessions),
+        nodes=MappingProxyType({n.id: n for _, _, n in sessions if n is not None}),
+    )
+
+
+def _json_safe(value):
+    # NaN (e.g. an "[N/A]" reading) isn't valid JSON
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, dict):
+        return {str(k): _json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(v) for v in value]
+    return value
+
+
+def print_ndjson(record: dict):
+    """
+    Write one record as a line of JSON, flushed immediately so consumers can process it right away.
+    """
+    print(json.dumps(_json_safe(record), allow_nan=False), flush=True)
+
+
+def list_clusters(beaker: Beaker, cache: MetadataCache = NO_CACHE) -> list[BeakerCluster]:
+    return cache.get_list("clusters", beaker.config.default_org or "default", BeakerCluster, lambda: list(beaker.cluster.list()))
+
 
-    interactive.sort(key=cmp_to_key(cmp))
-    noninteractive.sort(key=cmp_to_key(cmp))
-    return interactive, noninteractive
+def list_cluster_nodes(beaker: Beaker, cluster: BeakerCluster, cache: MetadataCache = NO_CACHE) -> list[BeakerNode]:
+    return cache.get_list("cluster_nodes", cluster.id, BeakerNode, lambda: list(beaker.node.list(cluster=cluster)))
+
+
+def list_cluster_jobs(beaker: Beaker, cluster: BeakerCluster) -> list[BeakerJob]:
+    """
+    All unfinalized jobs scheduled anywhere on the cluster, in a single (paged) query.
+    """
+    return list(beaker.job.list(scheduled_on_cluster=cluster, finalized=False))
+
+
+def iter_cluster_usage(beaker: Beaker, clusters: list[BeakerCluster], n_workers: int = DEFAULT_N_WORKERS,
+                       cache: MetadataCache = NO_CACHE) -> Iterator[tuple[BeakerCluster, list[BeakerNode], list[BeakerJob]]]:
+    """
+    Yield (cluster, nodes, unfinalized jobs) for each cluster as soon as both of its lookups are done, in completion order.
+    """
+    if len(clusters) == 0:
+        return
+    # a single pool bounds the total number of in-flight requests across all clusters
+    with ThreadPoolExecutor(n_workers) as executor:
+        node_futures = [executor.submit(list_cluster_nodes, beaker, c, cache) for c in clusters]
+        job_futures = [executor.submit(list_cluster_jobs, beaker, c) for c in clusters]
+        cluster_of = {f: i for i, fs in enumerate(zip(node_futures, job_futures)) for f in fs}
+        pending = [2] * len(clusters)
+        for future in as_completed(cluster_of):
+            i = cluster_of[future]
+            pending[i] -= 1
+            if pending[i] == 0:
+                yield clusters[i], node_futures[i].result(), job_futures[i].result()
+
+
+def get_node_gpu_usage(nodes: Iterable[BeakerNode], jobs: Iterable[BeakerJob]) -> dict[str, tuple[int, int]]:
+    """
+    Map the id of each GPU node to its (total, used) GPU counts, attributing jobs to nodes client-side.
+    """
+    used_gpus: dict[str, int] = defaultdict(int)
+    for job in jobs:
+        if job.assignment_details.node_id and job.assignment_details.HasField("resource_assignment"):
+            used_gpus[job.assignment_details.node_id] += len(job.assignment_details.resource_assignment.gpus)
+    return {
+        node.id: (len(node.node_resources.gpu_ids), used_gpus[node.id])
+        for node in nodes
+        if len(node.node_resources.gpu_ids) > 0
+    }
+
+
+def summarize_cluster_usage(cluster: BeakerCluster, nodes: Iterable[BeakerNode], jobs: Iterable[BeakerJob]) -> dict:
+    n_gpu, n_used_gpu = 0, 0
+    node_free_gpus = defaultdict(int)
+    for node_gpus, node_used_gpus in get_node_gpu_usage(nodes, jobs).values():
+        n_gpu += node_gpus
+        n_used_gpu += node_used_gpus
+        node_free_gpus[node_gpus - node_used_gpus] += 1
+    return {
+        "name": cluster.name,
+        "used_gpus": n_used_gpu,
+        "gpus": n_gpu,
+        "node_gpu_availability": {**node_free_gpus},
+    }
+
+
+def rank_clusters_by_availability(cluster_usage: Iterable[tuple[BeakerCluster, list[BeakerNode], list[BeakerJob]]],
+                                  gpus: int) -> list[tuple[BeakerCluster, int]]:
+    """
+    Rank clusters by how many of their (uncordoned) nodes currently have `gpus` free GPUs, best first,
+    returning each cluster with that number of nodes. Ties go to the cluster with the most free GPUs overall.
+    """
+    ranked = []
+    for cluster, nodes, jobs in cluster_usage:
+        nodes = [n for n in nodes if not n.cordon_details.HasField("cordoned")]
+        if gpus > 0:
+            free_gpus = [total - used for total, used in get_node_gpu_usage(nodes, jobs).values()]
+            n_fit = sum(free >= gpus for free in free_gpus)
+        else:
+            # any node can run a CPU-only session
+            free_gpus = []
+            n_fit = len(nodes)
+        ranked.append((cluster, n_fit, sum(free_gpus)))
+    ranked.sort(key=lambda x: (-x[1], -x[2], x[0].name))
+    return [(cluster, n_fit) for cluster, n_fit, _ in ranked]
 
 
-def find_clusters(beaker: Beaker, pattern: str):
-    clusters = beaker.cluster.list()
+def find_clusters(beaker: Beaker, pattern: str, cache: MetadataCache = NO_CACHE):
+    clusters = list_clusters(beaker, cache)
     return [c for c in clusters if re.match(pattern, f"{c.organization_name}/{c.name}")]
 
 
@@ -0,0 +1,128 @@
+"""
+Measure the wall time and number of Beaker API round trips of `list`, `attach`, `stop`, `clusters` and one
+`monitor` round at several account sizes, against the offline fake backend in benchmarks.fake_beaker.
+
+With --check, exits with an error if any command makes more round trips than its budget, which is the minimal number
+of calls the command needs for the synthetic account (e.g. one get_latest_job per workload and one node.get per
+distinct node), so that extra or repeated calls are caught without network access.
+
+Usage (from the repository root): python -m benchmarks.bench_commands [--scales 10 100 1000] [--latency MS] [--check]
+"""
+from argparse import ArgumentParser, Namespace
+from contextlib import closing, redirect_stdout
+import io
+import math
+import sys
+import time
+
+from beaker_util.clusters import clusters
+from beaker_util.monitor import usage_generator
+from beaker_util.sessions import attach, list_sessions, stop
+
+from benchmarks.fake_beaker import PAGE_SIZE, FakeBeaker, FakeWorld, fake_backend, make_world
+
+
+def pages(n: int) -> int:
+    return max(1, math.ceil(n / PAGE_SIZE))
+
+
+def session_budget(world: FakeWorld) -> int:
+    scheduled_nodes = {j.assignment_details.node_id for j in world.latest_jobs.values() if j.assignment_details.node_id}
+    # user.get + listing workloads + the latest job of each + each distinct node
+    return 1 + pages(len(world.workloads)) + len(world.workloads) + len(scheduled_nodes)
+
+
+def stop_budget(world: FakeWorld) -> int:
+    # resolving the sessions + one cancel call
+    return session_budget(world) + 1
+
+
+def clusters_budget(world: FakeWorld) -> int:
+    return pages(len(world.clusters)) + sum(
+        pages(sum(n.cluster_id == c.id for n in world.nodes)) + pages(len(world.jobs_on_cluster(c)))
+        for c in world.clusters
+    )
+
+
+def monitor_budget(world: FakeWorld) -> int:
+    experiments = [w for w in world.workloads if w.HasField("experiment")]
+    running_nodes = {j.assignment_details.node_id for j in world.running_experiments()}
+    return 1 + pages(len(experiments)) + len(experiments) + len(running_nodes)
+
+
+def run_list(world: FakeWorld):
+    list_sessions(Namespace(format="table", no_cache=True, refresh=False), [])
+
+
+def run_attach(world: FakeWorld):
+    attach(Namespace(session_idx=0, name=None, id=None, no_cache=True, refresh=False), [])
+
+
+def run_stop(world: FakeWorld):
+    stop(Namespace(session_idx=[0], name=None, id=None, match=None, all=False, queued=False, idle=False, dry_run=False,
+                   yes=True, n_workers=8, no_cache=True, refresh=False), [])
+
+
+def run_clusters(world: FakeWorld):
+    clusters(Namespace(filter=None, sort="total_gpus", all=False, print_node_availability=True, n_workers=8,
+                       format="table", sample=False, no_cache=True, refresh=False), [])
+
+
+def run_monitor(world: FakeWorld):
+    with closing(usage_generator(interval=0, timeout=5)) as gen:
+        next(gen)
+
+
+SCENARIOS = {
+    "list": (run_list, session_budget),
+    "attach": (run_attach, session_budget),
+    "stop": (run_stop, stop_budget),
+    "clusters": (run_clusters, clusters_budget),
+    "monitor (1 round)": (run_monitor, monitor_budget),
+}
+
+
+def run_scenario(name: str, world: FakeWorld, latency: float) -> tuple[float, FakeBeaker]:
+    """
+    Run one scenario against a fresh fake backend with the given latency (in seconds), returning the wall time and
+    the fake, whose `calls` hold the API calls (and SSH commands, as "ssh") that were made.
+    """
+    run, _ = SCENARIOS[name]
+    beaker = FakeBeaker(world, latency=latency)
+    with fake_backend(beaker, ssh_latency=latency), redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        run(world)
+        elapsed = time.perf_counter() - start
+    return elapsed, beaker
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark beakerutil commands against a fake Beaker backend")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10, 100, 1000], help="Numbers of workloads to benchmark with")
+    parser.add_argument("--latency", type=float, default=10, help="Latency of each API call and SSH command, in ms")
+    parser.add_argument("--commands", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS), help="Commands to benchmark")
+    parser.add_argument("--check", action="store_true", help="Exit with an error if a command exceeds its round trip budget")
+    args = parser.parse_args()
+
+    over_budget = []
+    print(f"{'workloads':>9}  {'command':<18} {'time (ms)':>10} {'API calls':>10} {'budget':>7} {'SSH cmds':>9}")
+    for scale in args.scales:
+        world = make_world(scale)
+        for name in args.commands:
+            _, budget = SCENARIOS[name]
+            elapsed, beaker = run_scenario(name, world, args.latency / 1000)
+            n_ssh = beaker.calls["ssh"]
+            n_api = beaker.n_calls - n_ssh
+            n_budget = budget(world)
+            flag = "  OVER BUDGET" if n_api > n_budget else ""
+            print(f"{scale:>9}  {name:<18} {elapsed * 1000:10.1f} {n_api:>10} {n_budget:>7} {n_ssh:>9}{flag}")
+            if n_api > n_budget:
+                over_budget.append(f"{name} at {scale} workloads: {n_api} calls ({dict(beaker.calls)}), budget {n_budget}")
+
+    if args.check and over_budget:
+        print("\nRound trip budget exceeded:\n" + "\n".join(over_budget), file=sys.stderr)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
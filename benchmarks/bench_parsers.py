@@ -0,0 +1,87 @@
+"""
+Compare the lightweight nvidia-smi / docker stats parsers used by `beakerutil monitor` against the pandas-based
+parsing they replaced, on synthetic outputs shaped like those recorded from real nodes.
+
+Usage (from the repository root): python -m benchmarks.bench_parsers [--hosts N] [--gpus N] [--containers N] [--repeat N]
+"""
+from argparse import ArgumentParser
+import io
+import json
+import subprocess
+import sys
+import timeit
+
+from beaker_util.collectors import parse_docker_output, parse_smi_output
+
+
+def make_smi_output(n_gpus: int) -> str:
+    lines = ["uuid, name, memory.used [MiB], memory.total [MiB], utilization.gpu [%]"]
+    for i in range(n_gpus):
+        lines.append(f"GPU-{i:08x}-5d1c-2f7e-9b3a-0c4e6f8a1b2c, NVIDIA H100 80GB HBM3, {1000 * i + 1} MiB, 81559 MiB, {(13 * i) % 100} %")
+    return "\n".join(lines) + "\n"
+
+
+def make_docker_output(n_containers: int) -> str:
+    lines = []
+    for i in range(n_containers):
+        lines.append(json.dumps({
+            "BlockIO": "183MB / 14.5GB",
+            "CPUPerc": f"{(37.5 * i) % 800:.2f}%",
+            "Container": f"{i:064x}",
+            "ID": f"{i:064x}",
+            "MemPerc": "1.44%",
+            "MemUsage": "14.83GiB / 1008GiB",
+            "Name": f"execution-01k0csrrm61ye677qb3bg1ca{i:02d}",
+            "NetIO": "3.57GB / 3.59MB",
+            "PIDs": "112",
+        }))
+    return "\n".join(lines) + "\n"
+
+
+def parse_smi_pandas(output: str):
+    import pandas as pd
+    return pd.read_csv(io.StringIO(output), skipinitialspace=True).set_index("uuid").to_dict("index")
+
+
+def parse_docker_pandas(output: str):
+    import pandas as pd
+    return pd.read_json(io.StringIO(output), lines=True).set_index("Name").to_dict("index")
+
+
+def bench(name: str, func, outputs: list[str], repeat: int):
+    # one "tick" of the monitor parses the output of every host
+    per_tick = min(timeit.repeat(lambda: [func(o) for o in outputs], number=1, repeat=repeat))
+    print(f"{name:<28} {per_tick * 1000:9.3f} ms per tick")
+    return per_tick
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark monitor output parsers")
+    parser.add_argument("--hosts", type=int, default=32, help="Number of hosts parsed per tick")
+    parser.add_argument("--gpus", type=int, default=8, help="GPUs per host")
+    parser.add_argument("--containers", type=int, default=8, help="Containers per host")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of ticks to time (the best is reported)")
+    args = parser.parse_args()
+
+    smi_outputs = [make_smi_output(args.gpus)] * args.hosts
+    docker_outputs = [make_docker_output(args.containers)] * args.hosts
+    print(f"{args.hosts} hosts, {args.gpus} GPUs and {args.containers} containers per host")
+
+    bench("nvidia-smi (lightweight)", parse_smi_output, smi_outputs, args.repeat)
+    bench("docker stats (lightweight)", parse_docker_output, docker_outputs, args.repeat)
+
+    try:
+        result = subprocess.run([sys.executable, "-c", "import time; t = time.perf_counter(); import pandas; print(time.perf_counter() - t)"],
+                                capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError:
+        print("pandas is not installed, skipping the pandas comparison")
+        return
+    print(f"{'import pandas':<28} {float(result.stdout) * 1000:9.3f} ms (once per process)")
+    assert parse_smi_pandas(smi_outputs[0]).keys() == parse_smi_output(smi_outputs[0]).keys()
+    assert parse_docker_pandas(docker_outputs[0]).keys() == parse_docker_output(docker_outputs[0]).keys()
+    bench("nvidia-smi (pandas)", parse_smi_pandas, smi_outputs, args.repeat)
+    bench("docker stats (pandas)", parse_docker_pandas, docker_outputs, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
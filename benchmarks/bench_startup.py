@@ -0,0 +1,66 @@
+"""
+Measure CLI startup cost, i.e. everything that happens before a subcommand starts doing network work.
+
+Usage (from the repository root): python -m benchmarks.bench_startup [--runs N] [--max-ms MS] [--importtime]
+"""
+from argparse import ArgumentParser
+import statistics
+import subprocess
+import sys
+import time
+
+
+COMMANDS = {
+    "beakerutil -h": [sys.executable, "-m", "beaker_util.main", "-h"],
+    "beakerutil list -h": [sys.executable, "-m", "beaker_util.main", "list", "-h"],
+    "beakerlaunch -h": [sys.executable, "-c", "import sys; sys.argv = ['beakerlaunch', '-h']; from beaker_util.launch_interactive import launch; launch()"],
+    "python (baseline)": [sys.executable, "-c", "pass"],
+}
+
+
+def time_command(cmd: list[str], runs: int) -> list[float]:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def print_importtime(top: int = 15):
+    """Print the slowest cumulative imports of beaker_util.main, as reported by `python -X importtime`."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import beaker_util.main"], capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines()[1:]:
+        self_us, cumulative_us, name = [x.strip() for x in line.replace("import time:", "").split("|")]
+        rows.append((int(cumulative_us), int(self_us), name))
+    rows.sort(reverse=True)
+    print(f"{'cumulative (ms)':>16} {'self (ms)':>10}  module")
+    for cumulative_us, self_us, name in rows[:top]:
+        print(f"{cumulative_us / 1000:16.1f} {self_us / 1000:10.1f}  {name}")
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark beakerutil startup time")
+    parser.add_argument("--runs", type=int, default=10, help="Number of runs per command")
+    parser.add_argument("--max-ms", type=float, default=None, help="Exit with an error if any command's median exceeds this")
+    parser.add_argument("--importtime", action="store_true", help="Also show the slowest imports of beaker_util.main")
+    args = parser.parse_args()
+
+    failed = False
+    for name, cmd in COMMANDS.items():
+        times = time_command(cmd, args.runs)
+        median = statistics.median(times)
+        print(f"{name:<24} median {median:7.1f} ms  min {min(times):7.1f} ms  max {max(times):7.1f} ms")
+        if args.max_ms is not None and "baseline" not in name and median > args.max_ms:
+            failed = True
+    if args.importtime:
+        print()
+        print_importtime()
+    if failed:
+        print(f"Startup exceeded {args.max_ms} ms!")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Offline stand-in for the Beaker API and for the SSH connections used by `beakerutil monitor`, so that commands can be
+benchmarked (and their round trips counted) without network access.
+
+A FakeWorld holds synthetic workloads, jobs, nodes and clusters built from the real protobuf messages. FakeBeaker
+serves it with a fixed latency per call, paging list calls the way the API does, and counts every call.
+"""
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from functools import cached_property
+import json
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+from beaker import BeakerCluster, BeakerJob, BeakerNode, BeakerWorkload, BeakerWorkloadStatus, BeakerWorkloadType
+
+from beaker_util import collectors, completion, daemon, utils
+
+
+USER_NAME = "bench"
+# Results per page of a list call
+PAGE_SIZE = 100
+
+
+@dataclass
+class FakeWorld:
+    clusters: list[BeakerCluster] = field(default_factory=list)
+    nodes: list[BeakerNode] = field(default_factory=list)
+    workloads: list[BeakerWorkload] = field(default_factory=list)
+    # latest job of each workload, by workload id
+    latest_jobs: dict[str, BeakerJob] = field(default_factory=dict)
+    # jobs of other users, which only show up when listing the jobs of a cluster
+    other_jobs: list[BeakerJob] = field(default_factory=list)
+
+    def jobs_on_cluster(self, cluster: BeakerCluster) -> list[BeakerJob]:
+        node_ids = {n.id for n in self.nodes if n.cluster_id == cluster.id}
+        return [j for j in list(self.latest_jobs.values()) + self.other_jobs if j.assignment_details.node_id in node_ids]
+
+    def running_experiments(self) -> list[BeakerJob]:
+        return [
+            self.latest_jobs[w.experiment.id] for w in self.workloads
+            if w.HasField("experiment") and self.latest_jobs[w.experiment.id].status.status == BeakerWorkloadStatus.running
+        ]
+
+    def smi_output(self, node: BeakerNode) -> str:
+        lines = ["uuid, name, memory.used [MiB], memory.total [MiB], utilization.gpu [%]"]
+        for i, gpu in enumerate(node.node_resources.gpu_ids):
+            lines.append(f"{gpu}, NVIDIA H100 80GB HBM3, {1000 * i + 1} MiB, 81559 MiB, {(13 * i) % 100} %")
+        return "\n".join(lines) + "\n"
+
+    def docker_output(self, node: BeakerNode) -> str:
+        lines = []
+        for i, job in enumerate(j for j in self.running_experiments() if j.assignment_details.node_id == node.id):
+            lines.append(json.dumps({
+                "BlockIO": "183MB / 14.5GB",
+                "CPUPerc": f"{(37.5 * i) % 800:.2f}%",
+                "MemUsage": "14.83GiB / 1008GiB",
+                "Name": f"execution-{job.id}".lower(),
+                "NetIO": "3.57GB / 3.59MB",
+                "PIDs": "112",
+            }))
+        return "\n".join(lines) + "\n"
+
+
+def _id(prefix: str, i: int) -> str:
+    # beaker ids are 26 character ULIDs
+    return f"01{prefix}{i:0{24 - len(prefix)}d}"
+
+
+def make_world(n_workloads: int, n_clusters: int = 10, gpus_per_node: int = 8) -> FakeWorld:
+    """
+    A deterministic world with `n_workloads` workloads of the benchmark user, a third of them sessions, spread over
+    roughly one node per four workloads. One in ten workloads is still queued, and the rest of each node's GPUs are
+    partly used by other users.
+    """
+    world = FakeWorld()
+    for i in range(n_clusters):
+        cluster = BeakerCluster(id=_id("CL", i), name=f"cluster-{i}", organization_name="bench")
+        world.clusters.append(cluster)
+    for i in range(max(1, n_workloads // 4)):
+        node = BeakerNode(id=_id("ND", i), hostname=f"node-{i}.bench", cluster_id=world.clusters[i % n_clusters].id)
+        node.node_resources.gpu_ids.extend(f"GPU-{i:06d}-{g}" for g in range(gpus_per_node))
+        world.nodes.append(node)
+
+    used_gpus = Counter()
+    for i in range(n_workloads):
+        workload = BeakerWorkload()
+        workload_id = _id("WL", i)
+        if i % 3 == 0:
+            workload.environment.id = workload_id
+        else:
+            workload.experiment.id = workload_id
+        workload.status = BeakerWorkloadStatus.running
+        world.workloads.append(workload)
+
+        job = BeakerJob(id=_id("JB", i), workload_id=workload_id, name=f"job-{i}" if i % 2 else "")
+        job.status.created.seconds = int(time.time()) - 3600 * (i % 48)
+        if i % 10 == 9:
+            job.status.status = BeakerWorkloadStatus.queued
+        else:
+            node = world.nodes[i % len(world.nodes)]
+            job.status.status = BeakerWorkloadStatus.running
+            job.assignment_details.node_id = node.id
+            job.assignment_details.resource_assignment.gpus.append(node.node_resources.gpu_ids[used_gpus[node.id] % gpus_per_node])
+            job.assignment_details.resource_assignment.cpu_count = 8
+            used_gpus[node.id] += 1
+        world.latest_jobs[workload_id] = job
+
+    for i, node in enumerate(world.nodes):
+        for g in range(used_gpus[node.id], min(used_gpus[node.id] + 2, gpus_per_node)):
+            job = BeakerJob(id=_id("OJ", len(world.other_jobs)))
+            job.status.status = BeakerWorkloadStatus.running
+            job.assignment_details.node_id = node.id
+            job.assignment_details.resource_assignment.gpus.append(node.node_resources.gpu_ids[g])
+            world.other_jobs.append(job)
+    return world
+
+
+class FakeBeaker:
+    """
+    Serves a FakeWorld through the subset of the Beaker client used by beakerutil, sleeping `latency` seconds per call
+    (per page, for list calls) and counting calls by name in `calls`.
+    """
+
+    def __init__(self, world: FakeWorld, latency: float = 0.01):
+        self.world = world
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self.config = SimpleNamespace(default_org="bench")
+        self.user = SimpleNamespace(get=lambda: self._call("user.get", SimpleNamespace(name=USER_NAME)))
+        self.organization = SimpleNamespace(get=lambda: self._call("organization.get", SimpleNamespace(name="bench")))
+        self.workload = SimpleNamespace(
+            list=self._list_workloads,
+            get_latest_job=lambda workload, **_: self._call("workload.get_latest_job", self.world.latest_jobs.get(self._workload_id(workload))),
+            is_environment=lambda workload: workload.HasField("environment"),
+            is_experiment=lambda workload: workload.HasField("experiment"),
+            cancel=self._cancel,
+        )
+        self.node = SimpleNamespace(
+            get=lambda node_id: self._call("node.get", next(n for n in self.world.nodes if n.id == node_id)),
+            list=lambda cluster, **_: self._paged("node.list", [n for n in self.world.nodes if n.cluster_id == cluster.id]),
+        )
+        self.cluster = SimpleNamespace(list=lambda **_: self._paged("cluster.list", self.world.clusters))
+        self.job = SimpleNamespace(
+            list=lambda scheduled_on_cluster, **_: self._paged("job.list", self.world.jobs_on_cluster(scheduled_on_cluster)),
+        )
+
+    @cached_property
+    def user_name(self) -> str:
+        return self.user.get().name
+
+    @property
+    def n_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def _call(self, name: str, result=None):
+        with self._lock:
+            self.calls[name] += 1
+        time.sleep(self.latency)
+        return result
+
+    def _paged(self, name: str, results: list):
+        # an empty result still takes a round trip
+        for start in range(0, max(len(results), 1), PAGE_SIZE):
+            self._call(name)
+            yield from results[start:start + PAGE_SIZE]
+
+    @staticmethod
+    def _workload_id(workload: BeakerWorkload) -> str:
+        return workload.experiment.id if workload.HasField("experiment") else workload.environment.id
+
+    def _list_workloads(self, author: str | None = None, finalized: bool | None = None, workload_type: BeakerWorkloadType | None = None, **_):
+        workloads = self.world.workloads
+        if workload_type == BeakerWorkloadType.experiment:
+            workloads = [w for w in workloads if w.HasField("experiment")]
+        elif workload_type == BeakerWorkloadType.environment:
+            workloads = [w for w in workloads if w.HasField("environment")]
+        return self._paged("workload.list", workloads)
+
+    def _cancel(self, *workloads: BeakerWorkload):
+        return self._call("workload.cancel", [self._workload_id(w) for w in workloads])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """
+    Stands in for `fabric.Connection` in polling mode, answering the combined nvidia-smi and docker stats probe from the world's nodes.
+    """
+
+    def __init__(self, world: FakeWorld, latency: float, calls: Counter, host: str, **_):
+        self.node = next(n for n in world.nodes if n.hostname == host)
+        self.world = world
+        self.latency = latency
+        self.calls = calls
+
+    def run(self, cmd: str, **_):
+        self.calls["ssh"] += 1
+        time.sleep(self.latency)
+        if cmd == collectors.POLL_CMD:
+            stdout = f"{self.world.smi_output(self.node)}{collectors.PROBE_DELIMITER}\n{self.world.docker_output(self.node)}"
+        else:
+            raise ValueError(f"Unexpected command: {cmd}")
+        return SimpleNamespace(stdout=stdout)
+
+    def close(self):
+        pass
+
+
+class _FakePool:
+    def __init__(self, beaker: FakeBeaker):
+        self.beaker = beaker
+
+    @contextmanager
+    def acquire(self):
+        yield self.beaker
+
+
+@contextmanager
+def fake_backend(beaker: FakeBeaker, ssh_latency: float = 0.01):
+    """
+    Route beakerutil's Beaker clients and SSH connections to the fakes, and turn the final exec into the beaker CLI
+    (as done by attach) into a no-op. SSH commands are counted in `beaker.calls["ssh"]`. The completion cache and the
+    daemon socket point into a temporary directory, so the user's real ones are neither overwritten nor contacted.
+    """
+    def connection(host: str, **kwargs):
+        return FakeConnection(beaker.world, ssh_latency, beaker.calls, host, **kwargs)
+
+    with ExitStack() as stack:
+        tmp_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.enter_context(mock.patch.object(completion, "SESSIONS_CACHE_PATH", os.path.join(tmp_dir, "sessions.json")))
+        stack.enter_context(mock.patch.object(daemon, "DAEMON_SOCKET_PATH", os.path.join(tmp_dir, "daemon.sock")))
+        stack.enter_context(mock.patch.object(utils, "BEAKER_POOL", _FakePool(beaker)))
+        stack.enter_context(mock.patch.object(collectors.fabric, "Connection", connection))
+        stack.enter_context(mock.patch("os.execlp"))
+        yield beaker
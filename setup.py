@@ -39,7 +39,7 @@ setup(
         "beaker-py~=2.0",
         "PyYAML~=6.0",
         "fabric~=3.2",
-        "pandas~=2.3",
+        "numpy>=1.24",
         "tabulate>=0.9.0,<1.0.0",
     ]
 )
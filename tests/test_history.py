@@ -0,0 +1,81 @@
+"""
+Behavior tests for the cluster availability history of `clusters --sample` and `clusters history`.
+"""
+from contextlib import closing
+import time
+
+import numpy as np
+import pytest
+
+from beaker_util.history import load_cluster_history, open_history, record_samples, summarize_history
+from beaker_util.utils import get_node_gpu_usage
+from benchmarks.fake_beaker import make_world
+
+
+def cluster_usage(world):
+    return [(c, [n for n in world.nodes if n.cluster_id == c.id], world.jobs_on_cluster(c)) for c in world.clusters]
+
+
+def local_time(hour: int, minute: int = 0) -> float:
+    # hours are bucketed in local time
+    return time.mktime((2026, 1, 5, hour, minute, 0, 0, 0, -1))
+
+
+def test_record_and_load(tmp_path):
+    world = make_world(40, n_clusters=2)
+    usage = cluster_usage(world)
+    # a cordoned node with free GPUs doesn't count as one that fits
+    cordoned = usage[0][1][0]
+    cordoned.cordon_details.cordoned.seconds = 1
+    with closing(open_history(str(tmp_path / "history.db"))) as conn:
+        assert record_samples(conn, usage, 1000.0) == (2, len(world.nodes))
+        record_samples(conn, usage, 2000.0)
+
+        for cluster, nodes, jobs in usage:
+            node_usage = get_node_gpu_usage(nodes, jobs)
+            free = sum(total - used for total, used in node_usage.values())
+            samples = load_cluster_history(conn, cluster.name, 0, None)
+            assert samples[:, :2].tolist() == [[1000.0, free], [2000.0, free]]
+            assert np.isnan(samples[:, 2]).all()
+
+            for gpus in (1, 6, 8):
+                fitting = sum(
+                    total - used >= gpus for node_id, (total, used) in node_usage.items() if node_id != cordoned.id
+                )
+                assert load_cluster_history(conn, cluster.name, 0, gpus)[:, 2].tolist() == [fitting, fitting]
+
+        assert load_cluster_history(conn, usage[0][0].name, 1500.0, 1)[:, 0].tolist() == [2000.0]
+        assert load_cluster_history(conn, "no-such-cluster", 0, 1).shape == (0, 3)
+
+
+def test_summary_by_hour():
+    samples = np.array([
+        [local_time(3, 0), 10, 1],
+        [local_time(3, 20), 20, 2],
+        [local_time(3, 40), 30, 3],
+        [local_time(4, 10), 40, 4],
+    ])
+    summary = summarize_history(samples, trend_hours=6)
+    assert [(h["hour"], h["samples"]) for h in summary["hours"]] == [(3, 3), (4, 1)]
+    hour_3 = summary["hours"][0]
+    assert (hour_3["free_gpus_p10"], hour_3["free_gpus_p50"], hour_3["free_gpus_p90"]) == pytest.approx((12, 20, 28))
+    assert hour_3["nodes_p50"] == 2
+    assert (summary["last_sample"], summary["free_gpus"], summary["nodes"]) == (local_time(4, 10), 40, 4)
+
+
+def test_summary_without_node_counts():
+    samples = np.array([[local_time(3), 10, np.nan], [local_time(4), 20, np.nan]])
+    summary = summarize_history(samples, trend_hours=6)
+    assert summary["nodes"] is None
+    assert all("nodes_p50" not in h for h in summary["hours"])
+
+
+def test_trend():
+    # free GPUs drop by 2 per hour over the last 6 hours, after a much higher level that is outside the window
+    times = [local_time(1)] + [local_time(h) for h in range(6, 13)]
+    samples = np.array([[t, 100 if i == 0 else 40 - 2 * i, np.nan] for i, t in enumerate(times)])
+    assert summarize_history(samples, trend_hours=6)["trend_free_gpus_per_hour"] == pytest.approx(-2)
+
+    # samples taken back to back don't make a trend
+    samples = np.array([[local_time(6, 0), 10, np.nan], [local_time(6, 1), 20, np.nan], [local_time(6, 2), 30, np.nan]])
+    assert summarize_history(samples, trend_hours=6)["trend_free_gpus_per_hour"] is None
@@ -0,0 +1,127 @@
+"""
+Behavior tests for `monitor --record` files: the binary record layout, recovery from a truncated trailing record, and
+the per-job statistics of `monitor summary`.
+"""
+import math
+
+import pytest
+
+from beaker_util.collectors import HostSample, parse_docker_output, parse_smi_output
+from beaker_util.recording import RECORD_STRUCT, RECORDING_MAGIC, Recorder, load_recording, summarize_recording
+from benchmarks.fake_beaker import make_world
+
+
+def make_samples(world, updated: float) -> tuple[list, dict[str, HostSample]]:
+    nodes = {n.id: n for n in world.nodes}
+    experiments = [(j, nodes[j.assignment_details.node_id]) for j in world.running_experiments()]
+    samples = {
+        node.hostname: HostSample(parse_smi_output(world.smi_output(node)), parse_docker_output(world.docker_output(node)), updated)
+        for node in world.nodes
+    }
+    return experiments, samples
+
+
+def write_recording(path, rows: list[tuple]) -> None:
+    """Write a recording with one record per row of (time, job, gpus, gpu util, cpu, ram), the other fields zeroed."""
+    with open(path, "wb") as f:
+        f.write(RECORDING_MAGIC)
+        for t, job, n_gpus, gpu_util, cpu, ram in rows:
+            f.write(RECORD_STRUCT.pack(t, job.encode("ascii"), n_gpus, gpu_util, 0, 0, cpu, ram, 0, 0, 0, 0))
+
+
+def test_records_round_trip(tmp_path):
+    world = make_world(10)
+    experiments, samples = make_samples(world, 1000.0)
+    path = str(tmp_path / "usage.bin")
+    recorder = Recorder(path)
+    recorder.record(experiments, samples)
+    # the same samples again aren't recorded twice
+    recorder.record(experiments, samples)
+    recorder.record(experiments, make_samples(world, 1010.0)[1])
+
+    records = load_recording(path)
+    assert len(records) == 2 * len(experiments)
+    assert list(records["time"]) == [1000.0] * len(experiments) + [1010.0] * len(experiments)
+    assert [j.decode("ascii") for j in records["job"][:len(experiments)]] == [j.id for j, _ in experiments]
+    for record, (job, node) in zip(records, experiments):
+        gpu = job.assignment_details.resource_assignment.gpus[0]
+        gpu_idx = list(node.node_resources.gpu_ids).index(gpu)
+        assert record["n_gpus"] == 1
+        assert record["gpu_util"] == (13 * gpu_idx) % 100
+        assert record["vram_used"] == 1000 * gpu_idx + 1
+        assert record["ram"] == pytest.approx(14.83 * 2 ** 30)
+
+
+def test_stale_and_missing_samples_are_skipped(tmp_path):
+    world = make_world(10)
+    experiments, samples = make_samples(world, 1000.0)
+    stale_host = experiments[0][1].hostname
+    samples[stale_host].stale = True
+    path = str(tmp_path / "usage.bin")
+    Recorder(path).record(experiments, samples)
+    assert len(load_recording(path)) == sum(node.hostname != stale_host for _, node in experiments)
+
+
+def test_reopening_drops_truncated_trailing_record(tmp_path):
+    world = make_world(10)
+    experiments, samples = make_samples(world, 1000.0)
+    path = str(tmp_path / "usage.bin")
+    Recorder(path).record(experiments, samples)
+    with open(path, "ab") as f:
+        # a record cut short by a crash
+        f.write(b"\x01" * 7)
+
+    Recorder(path).record(experiments, make_samples(world, 1010.0)[1])
+    records = load_recording(path)
+    assert len(records) == 2 * len(experiments)
+    assert set(records["time"]) == {1000.0, 1010.0}
+    assert {r["job"] for r in summarize_recording(records)} == {j.id for j, _ in experiments}
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("not a recording\n")
+    with pytest.raises(ValueError):
+        Recorder(str(path))
+    with pytest.raises(ValueError):
+        load_recording(str(path))
+
+
+def test_summary_statistics(tmp_path):
+    job_a, job_b = "01JB0000000000000000000001", "01JB0000000000000000000002"
+    path = tmp_path / "usage.bin"
+    # interleaved, as written by the recorder; job b has no GPUs, so its GPU utilization is NaN
+    write_recording(path, [
+        (100, job_a, 2, 50, 100, 1e9),
+        (100, job_b, 0, math.nan, 400, 5e9),
+        (110, job_a, 2, 2, 100, 3e9),
+        (110, job_b, 0, math.nan, 200, math.nan),
+        (120, job_a, 2, math.nan, 100, 2e9),
+        (130, job_a, 2, 100, 100, 1e9),
+        (140, job_a, 2, 0, 100, 1e9),
+    ])
+    summary = {r["job"]: r for r in summarize_recording(load_recording(str(path)))}
+
+    a = summary[job_a]
+    assert (a["samples"], a["start"], a["duration"], a["gpus"]) == (5, 100, 40, 2)
+    # NaN readings are left out: the valid ones are 50, 2, 100 and 0
+    assert a["mean_gpu_util"] == pytest.approx(38)
+    assert a["p95_gpu_util"] == 100
+    assert a["idle_fraction"] == pytest.approx(0.5)
+    assert a["max_ram"] == 3e9
+
+    b = summary[job_b]
+    assert (b["samples"], b["duration"], b["gpus"]) == (2, 10, 0)
+    assert math.isnan(b["mean_gpu_util"]) and math.isnan(b["p95_gpu_util"]) and math.isnan(b["idle_fraction"])
+    assert b["mean_cpu"] == pytest.approx(300)
+    assert b["max_ram"] == 5e9
+
+
+def test_summary_rejects_corrupt_job_ids(tmp_path):
+    path = tmp_path / "usage.bin"
+    write_recording(path, [(100, "01JB0000000000000000000001", 1, 50, 100, 1e9)])
+    with open(path, "r+b") as f:
+        f.seek(len(RECORDING_MAGIC) + 8)
+        f.write(b"\xff")
+    with pytest.raises(ValueError, match="corrupt job id"):
+        summarize_recording(load_recording(str(path)))
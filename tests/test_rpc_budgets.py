@@ -0,0 +1,17 @@
+"""
+RPC-count regression tests: every benchmarked command must stay within its round trip budget on a small synthetic
+account. Run from the repository root with `python -m pytest`.
+"""
+import pytest
+
+from benchmarks.bench_commands import SCENARIOS, run_scenario
+from benchmarks.fake_beaker import make_world
+
+
+@pytest.mark.parametrize("name", list(SCENARIOS))
+def test_api_calls_within_budget(name):
+    world = make_world(10)
+    _, budget = SCENARIOS[name]
+    _, beaker = run_scenario(name, world, latency=0)
+    n_api = beaker.n_calls - beaker.calls["ssh"]
+    assert n_api <= budget(world), f"{name} made {n_api} API calls ({dict(beaker.calls)}), budget {budget(world)}"